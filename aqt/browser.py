@@ -4,24 +4,153 @@
 
 import sre_constants
 from aqt.qt import *
-import time, types, sys, re
+import time, types, sys, re, cgi, hashlib, simplejson, traceback
+from array import array
 from operator import attrgetter, itemgetter
 import anki, anki.utils, aqt.forms
-from anki.utils import fmtTimeSpan, ids2str, stripHTMLMedia, isWin, intTime
+from anki.utils import fmtTimeSpan, ids2str, stripHTMLMedia, isWin, intTime, \
+    splitFields, joinFields
 from aqt.utils import saveGeom, restoreGeom, saveSplitter, restoreSplitter, \
     saveHeader, restoreHeader, saveState, restoreState, applyStyles, getTag, \
-    showInfo, askUser, tooltip, openHelp, fontForPlatform
+    showInfo, askUser, tooltip, openHelp, fontForPlatform, LRUCache
 from anki.errors import *
 from anki.db import *
 from anki.hooks import runHook, addHook, remHook
+from anki.find import Finder
 from aqt.webview import AnkiWebView
 from aqt.toolbar import Toolbar
 
 COLOUR_SUSPENDED = "#fffff0"
 COLOUR_MARKED = "#eeeeff"
 
+# row state flags
+FLAG_SUSPENDED = 1
+FLAG_BURIED = 2
+FLAG_MARKED = 4
+
 # fixme: need to refresh after undo
 
+# Row records
+##########################################################################
+
+class BrowserRow(object):
+    "Compact copy of the card & note columns needed to display a row."
+
+    __slots__ = ("id", "nid", "did", "ord", "mod", "type", "queue", "due",
+                 "ivl", "factor", "reps", "lapses", "mid", "ndid", "nmod",
+                 "tags", "flds")
+
+    sql = """
+select c.id, c.nid, c.did, c.ord, c.mod, c.type, c.queue, c.due, c.ivl,
+c.factor, c.reps, c.lapses, n.mid, n.did, n.mod, n.tags, n.flds
+from cards c, notes n where c.nid = n.id and c.id in %s"""
+
+    def __init__(self, data):
+        (self.id, self.nid, self.did, self.ord, self.mod, self.type,
+         self.queue, self.due, self.ivl, self.factor, self.reps, self.lapses,
+         self.mid, self.ndid, self.nmod, self.tags, self.flds) = data
+
+# Search results
+##########################################################################
+
+# card ids need 64 bits; where a C long is smaller, a double holds them
+# exactly
+if array('l').itemsize >= 8:
+    _idType = 'l'
+else:
+    _idType = 'd'
+
+class ResultIds(object):
+    """The card ids of a search, stored in a typed array instead of a list
+of int objects. Reversing flips the direction rows are read in, so it
+doesn't copy the ids, and the array can be shared between views."""
+
+    def __init__(self, ids=(), backwards=False):
+        if isinstance(ids, array):
+            self._ids = ids
+        else:
+            self._ids = array(_idType, ids)
+        self.backwards = backwards
+
+    def view(self):
+        "A copy sharing the same ids."
+        return ResultIds(self._ids, self.backwards)
+
+    def snapshot(self):
+        "A value that compares equal while the ids and order are unchanged."
+        return (self._ids, self.backwards)
+
+    def reverse(self):
+        self.backwards = not self.backwards
+
+    def itemSize(self):
+        return self._ids.itemsize
+
+    def _list(self, ids):
+        if _idType == 'l':
+            return ids.tolist()
+        return [int(id) for id in ids]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, i):
+        n = len(self._ids)
+        if isinstance(i, slice):
+            start, stop, step = i.indices(n)
+            if step != 1:
+                return list(self)[i]
+            if stop <= start:
+                return []
+            if not self.backwards:
+                return self._list(self._ids[start:stop])
+            ids = self._list(self._ids[n-stop:n-start])
+            ids.reverse()
+            return ids
+        if i < 0:
+            i += n
+        if self.backwards:
+            i = n - 1 - i
+        if i < 0 or i >= n:
+            raise IndexError(i)
+        return int(self._ids[i])
+
+    def __iter__(self):
+        if self.backwards:
+            ids = reversed(self._ids)
+        else:
+            ids = iter(self._ids)
+        if _idType == 'l':
+            return ids
+        return (int(id) for id in ids)
+
+    def __contains__(self, id):
+        return id in self._ids
+
+    def index(self, id):
+        i = self._ids.index(id)
+        if self.backwards:
+            return len(self._ids) - 1 - i
+        return i
+
+# approximate memory used by cached objects, for the cache budget
+
+def _rowSize(r):
+    return 200 + 2*(len(r.flds) + len(r.tags))
+
+def _keySize(k):
+    return 100 + 2*len(k[1])
+
+def _cardSize(c):
+    size = 1000
+    n = getattr(c, "_note", None)
+    if n:
+        size += 500 + 2*sum(len(f) for f in n.fields)
+    qa = getattr(c, "_qa", None)
+    if qa:
+        size += 2*(len(qa['q']) + len(qa['a']))
+    return size
+
 # Data model
 ##########################################################################
 
@@ -34,23 +163,117 @@ class DataModel(QAbstractTableModel):
         self.sortKey = None
         self.activeCols = self.col.conf.get(
             "activeCols", ["noteFld", "template", "cardDue", "deck"])
-        self.cards = []
-        self.cardObjs = {}
+        self.cards = ResultIds()
+        self.flags = array('B')
+        self.savedCards = None
+        self.selectedCards = set()
+        self.selectedRanges = []
+        self.searchThread = None
+        self._threads = []
+        self._resumeTxt = None
+        self.lastSearch = None
+        self.clearLookups()
+        budget = self.browser.mw.pm.profile.get('browserCacheMB', 20)*1024*1024
+        # split between full card objects, row records, question/answer
+        # sort keys and column text
+        self.cardObjs = LRUCache(budget/4, _cardSize)
+        self.rows = LRUCache(budget/4, _rowSize)
+        self.qaKeys = LRUCache(budget/4, _keySize)
+        self.texts = LRUCache(budget/4, _keySize)
+        self.resultCache = LRUCache(
+            self.browser.mw.pm.profile.get('searchCacheMB', 5)*1024*1024,
+            lambda ids: 100 + ids.itemSize()*len(ids))
 
     def getCard(self, index):
-        id = self.cards[index.row()]
-        if not id in self.cardObjs:
-            self.cardObjs[id] = self.col.getCard(id)
-        return self.cardObjs[id]
+        return self._loadCard(self.cards[index.row()])
+
+    def _loadCard(self, id):
+        c = self.cardObjs.get(id)
+        if c is None:
+            c = self.col.getCard(id)
+            # the note will be loaded on first use, so account for it now
+            c.note()
+            self.cardObjs[id] = c
+        return c
 
     def refreshNote(self, note):
-        refresh = False
-        for c in note.cards():
-            if c.id in self.cardObjs:
-                del self.cardObjs[c.id]
-                refresh = True
-        if refresh:
-            self.emit(SIGNAL("layoutChanged()"))
+        # the note may no longer match the last search
+        self.lastSearch = None
+        self.refreshCards([c.id for c in note.cards()])
+
+    def refreshCards(self, cids):
+        "Redraw the rows of CIDS, which have been modified."
+        for id in cids:
+            self.cardObjs.pop(id)
+            self.rows.pop(id)
+            for type in self.textCols:
+                self.texts.pop((type, id))
+        rows = self._updateFlags(cids)
+        last = self.columnCount(None) - 1
+        for (top, bottom) in self._coalesce(rows):
+            self.emit(SIGNAL("dataChanged(QModelIndex,QModelIndex)"),
+                      self.index(top, 0), self.index(bottom, last))
+
+    def mayChange(self, keys, sorts):
+        """True if modifying cards may change which cards match the current
+search or their order. KEYS are the search prefixes that could be
+affected, and SORTS the affected sort columns."""
+        if self.lastSearch is None:
+            return True
+        if self.sortType() in sorts:
+            return True
+        txt = self.lastSearch.lower()
+        for k in keys:
+            if k + ":" in txt:
+                return True
+
+    # Row hydration
+    ######################################################################
+    # Display data is fetched for the visible rows plus a margin in a single
+    # query, so painting and scrolling don't need to touch the DB per cell.
+
+    rowMargin = 50
+
+    def getRow(self, index):
+        "The BrowserRow at INDEX, or None if its card has been deleted."
+        id = self.cards[index.row()]
+        r = self.rows.get(id)
+        if r is None:
+            r = self._hydrate(index.row()).get(id)
+        return r
+
+    def _visibleRows(self):
+        tv = self.browser.form.tableView
+        height = tv.verticalHeader().defaultSectionSize() or 1
+        return tv.viewport().height() / height + 1
+
+    def _hydrate(self, row):
+        "Load the rows around ROW, returning them as {id: BrowserRow}."
+        start = max(0, row - self.rowMargin)
+        end = min(len(self.cards), row + self._visibleRows() + self.rowMargin)
+        window = self.cards[start:end]
+        ids = [id for id in window if id not in self.rows]
+        fetched = dict(
+            (data[0], BrowserRow(data)) for data in
+            self.col.db.execute(BrowserRow.sql % ids2str(ids)))
+        # with large notes the whole window may not fit in the cache, so
+        # only the rows nearest ROW that fit are kept
+        near = sorted((abs(start + i - row), id)
+                      for (i, id) in enumerate(window) if id in fetched)
+        room = self.rows.maxSize
+        keep = []
+        for (dist, id) in near:
+            room -= _rowSize(fetched[id])
+            if room < 0:
+                break
+            keep.append(id)
+        types = [t for t in self.activeCols if t in self.textCols]
+        # nearest last, so they're the most recently used
+        for id in reversed(keep):
+            r = self.rows[id] = fetched[id]
+            for type in types:
+                self.displayText(type, r)
+        return fetched
 
     # Model interface
     ######################################################################
@@ -103,43 +326,327 @@ class DataModel(QAbstractTableModel):
     ######################################################################
 
     def search(self, txt, reset=True):
+        self.cancelSearch()
+        self._resumeTxt = None
         if reset:
+            # make sure pending edits are included
+            self.browser.editor.saveNow()
+            key = self._cacheKey(txt)
+            ids = key and self.resultCache.get(key)
+            if ids is not None:
+                return self._setResults(txt, ids.view())
+            terms = self._refinement(txt)
+            if terms:
+                return self._narrow(txt, terms)
+            # the search thread can't see uncommitted changes
+            if not self.col.db.mod:
+                return self._startSearch(txt)
             self.beginReset()
-        t = time.time()
         # the db progress handler may cause a refresh, so we need to zero out
         # old data first
-        self.cards = []
-        self.cards = self.col.findCards(txt, self.browser.mw.pm.profile['fullSearch'])
-        print "fetch cards in %dms" % ((time.time() - t)*1000)
+        self.cards = ResultIds()
+        self.lastSearch = None
+        self.cards = ResultIds(self._sortLocal(self.col.findCards(
+            self._indexedQuery(txt), self.browser.mw.pm.profile['fullSearch'])))
+        self.lastSearch = txt
         if reset:
             self.endReset()
+        self.browser.onSearchDone()
 
     def reset(self):
         self.beginReset()
         self.endReset()
 
     def beginReset(self):
+        # a search started before an edit may return stale results
+        self._resumeTxt = self.cancelSearch()
         self.browser.editor.saveNow()
         self.browser.editor.setNote(None, hide=False)
         self.browser.mw.progress.start()
         self.saveSelection()
+        self.browser._selection = None
         self.beginResetModel()
-        self.cardObjs = {}
+        self.cardObjs.clear()
+        self.rows.clear()
+        self.clearLookups()
 
     def endReset(self):
-        t = time.time()
+        self._buildFlags()
         self.endResetModel()
         self.restoreSelection()
         self.browser.mw.progress.finish()
+        if self._resumeTxt is not None:
+            txt = self._resumeTxt
+            self._resumeTxt = None
+            self.search(txt)
 
-    def reverse(self):
+    # Background searching
+    ######################################################################
+    # Searches are run in a thread, and the results are swapped in when they
+    # arrive. Starting a new search cancels the previous one.
+
+    def _setResults(self, txt, ids, key=None):
+        "Swap in the results of a completed search, caching them if possible."
+        if not isinstance(ids, ResultIds):
+            ids = ResultIds(ids)
+        if key and key == self._cacheKey(txt):
+            self.resultCache[key] = ids.view()
         self.beginReset()
-        self.cards.reverse()
+        self.cards = ids
+        self.lastSearch = txt
         self.endReset()
+        self.browser.onSearchDone()
+
+    def _startSearch(self, txt):
+        t = self.searchThread = SearchThread(
+            self.col, txt, self.browser.mw.pm.profile['fullSearch'],
+            self._indexedQuery(txt))
+        t.key = self._cacheKey(txt)
+        self.connect(t, SIGNAL("finished()"),
+                     lambda t=t: self._onSearchFinished(t))
+        self._threads.append(t)
+        t.start()
+
+    def _onSearchFinished(self, t):
+        self._threads.remove(t)
+        if t is not self.searchThread:
+            # cancelled or superseded
+            return
+        self.searchThread = None
+        if t.result is None:
+            # failed; search again in the main thread so errors are reported
+            # as usual
+            self.beginReset()
+            self.search(t.txt, reset=False)
+            self.endReset()
+            return
+        self._setResults(t.txt, self._sortLocal(t.result), t.key)
+
+    # Incremental narrowing
+    ######################################################################
+    # When a search only adds plain text terms to the previous search, the
+    # new results are a subset of the old ones, so we filter those instead
+    # of searching the whole collection again.
+
+    _plainTerm = re.compile(r"^[^-:()\"'*_%\\][^:()\"'*_%\\]*$")
+
+    def _refinement(self, txt):
+        "Extra terms if TXT narrows the current results, or None."
+        old = self.lastSearch
+        if old is None or not txt.startswith(old + " "):
+            return
+        if old.count('"') % 2 or old.count("'") % 2:
+            return
+        oldTerms = old.split()
+        if oldTerms and oldTerms[-1] == "-":
+            return
+        for t in oldTerms:
+            if t.lower() == "or" or "(" in t or ")" in t:
+                return
+        terms = txt[len(old):].split()
+        for t in terms:
+            if t.lower() in ("or", "and") or not self._plainTerm.match(t):
+                return
+        return terms
+
+    def _narrow(self, txt, terms):
+        # the new terms are matched by the normal search, limited to the
+        # notes of the current results
+        query = " ".join(terms)
+        full = self.browser.mw.pm.profile['fullSearch']
+        keep = set()
+        for i in range(0, len(self.cards), 1000):
+            nids = self.col.db.list(
+                "select distinct nid from cards where id in %s" %
+                ids2str(self.cards[i:i+1000]))
+            keep.update(self.col.findCards("nid:%s %s" % (
+                ",".join([str(n) for n in nids]), query), full))
+        self._setResults(txt, [id for id in self.cards if id in keep],
+                         self._cacheKey(txt))
+
+    # Local sorting
+    ######################################################################
+    # libanki can only sort on columns stored in the DB, so the browser
+    # sorts the other columns itself, building a key for each card in the
+    # results. Rendered question/answer keys are kept between searches and
+    # only rebuilt when the note or model changes.
+
+    localSorts = ("question", "answer", "template", "deck", "ndeck")
+
+    def sortType(self):
+        return self.col.conf.get('browserSort') or self.col.conf['sortType']
+
+    def _sortLocal(self, ids):
+        type = self.col.conf.get('browserSort')
+        if not type or not ids:
+            return ids
+        keys = self._sortKeys(type, ids)
+        ids = sorted(ids, key=keys.get)
+        if self.col.conf['sortBackwards']:
+            ids.reverse()
+        return ids
+
+    def _sortKeys(self, type, ids):
+        keys = {}
+        names = {}
+        mm = self.col.models
+        # with more cards than fit in the cache, keep the keys that do fit
+        # instead of letting each new key push out one the next sort will
+        # need; USED counts the cached keys this sort has touched
+        used = 0
+        self.browser.mw.progress.start()
+        for i in range(0, len(ids), 1000):
+            for (id, did, ndid, mid, ord, nmod) in self.col.db.execute("""
+select c.id, c.did, n.did, n.mid, c.ord, n.mod from cards c, notes n
+where c.nid = n.id and c.id in %s""" % ids2str(ids[i:i+1000])):
+                if type == "deck" or type == "ndeck":
+                    if type == "ndeck":
+                        did = ndid
+                    if did not in names:
+                        names[did] = self.deckName(did).lower()
+                    keys[id] = names[did]
+                elif type == "template":
+                    keys[id] = self.templateName(mid, ord).lower()
+                else:
+                    ver = (nmod, mm.get(mid)['mod'])
+                    old = self.qaKeys.get((type, id))
+                    if old and old[0] == ver:
+                        k = old
+                        used += 1
+                    else:
+                        c = self.col.getCard(id)
+                        if type == "question":
+                            txt = c.q()
+                        else:
+                            txt = c.a()
+                        k = (ver, self.formatQA(txt)[:100].lower())
+                        if (old or used < len(self.qaKeys) or
+                            self.qaKeys.size + _keySize(k) <=
+                            self.qaKeys.maxSize):
+                            self.qaKeys[(type, id)] = k
+                            used += 1
+                    keys[id] = k[1]
+            self.browser.mw.progress.update()
+        self.browser.mw.progress.finish()
+        return keys
+
+    # Text index
+    ######################################################################
+    # When searching within formatting, plain text terms are looked up in
+    # the text index first, and the search is limited to the notes found.
+
+    def _indexedQuery(self, txt):
+        idx = self.browser.mw.textIndex
+        if not idx or not self.browser.mw.pm.profile['fullSearch']:
+            return txt
+        nids = idx.candidates(self.col, txt)
+        if nids is None or len(nids) > 50000:
+            return txt
+        return "nid:%s %s" % (",".join([str(n) for n in nids]) or "0", txt)
+
+    # Result cache
+    ######################################################################
+    # Results are cached by query, sort order and the collection's
+    # modification time, plus the scheduler's day so that searches like
+    # is:due and rated: don't outlive midnight. Uncommitted changes may
+    # affect any search, so nothing is cached or reused while there are
+    # unsaved edits.
+
+    def _cacheKey(self, txt):
+        if self.col.db.mod:
+            return
+        return (" ".join(txt.split()), self.sortType(),
+                self.col.conf['sortBackwards'],
+                self.browser.mw.pm.profile['fullSearch'], self.col.mod,
+                self.col.sched.today)
+
+    def cancelSearch(self, wait=False):
+        "Cancel any running search, returning its text."
+        t = self.searchThread
+        self.searchThread = None
+        if wait:
+            for t2 in self._threads:
+                t2.cancel()
+                t2.wait()
+        if t:
+            t.cancel()
+            return t.txt
+
+    def reverse(self):
+        "Reverse the order of the rows, keeping the selection."
+        self.saveSelection()
+        n = len(self.cards)
+        self.emit(SIGNAL("layoutAboutToBeChanged()"))
+        self.cards.reverse()
+        self.flags.reverse()
+        self.emit(SIGNAL("layoutChanged()"))
+        # the same cards are selected, in mirrored rows
+        self.selectedRanges = [
+            (n-1-bottom, n-1-top) for (top, bottom) in
+            reversed(self.selectedRanges)]
+        self.savedCards = self.cards.snapshot()
+        self.restoreSelection()
+
+    # Row flags
+    ######################################################################
+    # The state used to colour rows is computed for all results in one query
+    # whenever the model is reset, so painting doesn't need to load cards.
+
+    def _flagSql(self, limit):
+        return """
+select c.id, c.queue, n.tags like '% marked %' from cards c, notes n
+where c.nid = n.id and (c.queue < 0 or n.tags like '% marked %')""" + limit
+
+    def _buildFlags(self):
+        if len(self.cards) < 1000:
+            limit = " and c.id in %s" % ids2str(self.cards)
+        else:
+            limit = ""
+        flagged = self._fetchFlags(limit)
+        self.flags = array('B', [flagged.get(id, 0) for id in self.cards])
+
+    def _updateFlags(self, ids):
+        "Update the flags of IDS, returning their rows."
+        flagged = self._fetchFlags(" and c.id in %s" % ids2str(ids))
+        if len(ids) < 100:
+            # a few searches of the id array are cheaper than a python
+            # loop over every row
+            rows = []
+            for id in ids:
+                try:
+                    rows.append(self.cards.index(id))
+                except ValueError:
+                    pass
+            rows.sort()
+        else:
+            ids = set(ids)
+            rows = [row for (row, id) in enumerate(self.cards) if id in ids]
+        for row in rows:
+            self.flags[row] = flagged.get(self.cards[row], 0)
+        return rows
+
+    def _fetchFlags(self, limit):
+        flagged = {}
+        for (id, queue, marked) in self.col.db.execute(self._flagSql(limit)):
+            f = 0
+            if queue == -1:
+                f |= FLAG_SUSPENDED
+            elif queue < -1:
+                f |= FLAG_BURIED
+            if marked:
+                f |= FLAG_MARKED
+            flagged[id] = f
+        return flagged
+
+    # Selection
+    ######################################################################
+    # Selections are saved and restored as ranges of rows, so that large
+    # selections don't need to be walked one row at a time.
 
     def saveSelection(self):
-        cards = self.browser.selectedCards()
-        self.selectedCards = dict([(id, True) for id in cards])
+        self.selectedRanges = self.browser.selectedRanges()
+        self.selectedCards = set(self.browser.selectedCards())
+        self.savedCards = self.cards.snapshot()
         if getattr(self.browser, 'card', None):
             self.focusedCard = self.browser.card.id
         else:
@@ -150,35 +657,54 @@ class DataModel(QAbstractTableModel):
             return
         sm = self.browser.form.tableView.selectionModel()
         sm.clear()
-        # restore selection
-        items = QItemSelection()
-        focused = None
-        first = None
-        count = 0
-        for row, id in enumerate(self.cards):
-            if id in self.selectedCards:
-                count += 1
-                idx = self.index(row, 0)
-                items.select(idx, idx)
-                if not first:
-                    first = idx
-                # note idx of focused card
-                if self.focusedCard:
-                    focused = idx
-                    # avoid further comparisons
-                    self.focusedCard = None
-        # and focus previously focused or first in selection
-        focus = focused or first
-        tv = self.browser.form.tableView
-        if focus:
-            tv.selectRow(focus.row())
-            tv.scrollTo(focus, tv.PositionAtCenter)
-            if count < 500:
-                # discard large selections; they're too slow
-                sm.select(items, QItemSelectionModel.SelectCurrent |
-                          QItemSelectionModel.Rows)
+        if self.cards.snapshot() == self.savedCards:
+            # same rows as before, so the old ranges are still valid
+            ranges = self.selectedRanges
         else:
+            ranges = self._rangesForIds(self.selectedCards)
+        self.savedCards = None
+        # focus previously focused or first in selection
+        focus = None
+        if self.focusedCard and (
+            self.focusedCard in self.selectedCards or not ranges):
+            try:
+                focus = self.cards.index(self.focusedCard)
+            except ValueError:
+                pass
+        if focus is None and ranges:
+            focus = ranges[0][0]
+        tv = self.browser.form.tableView
+        if focus is None:
             tv.selectRow(0)
+            return
+        tv.selectRow(focus)
+        tv.scrollTo(self.index(focus, 0), tv.PositionAtCenter)
+        items = QItemSelection()
+        last = self.columnCount(None) - 1
+        for (top, bottom) in ranges:
+            items.select(self.index(top, 0), self.index(bottom, last))
+        sm.select(items, QItemSelectionModel.SelectCurrent |
+                  QItemSelectionModel.Rows)
+
+    def _rangesForIds(self, ids):
+        "Return contiguous (top, bottom) row ranges of cards in IDS."
+        ranges = []
+        if not ids:
+            return ranges
+        if len(ids) == len(self.cards) and ids.issuperset(self.cards):
+            return [(0, len(self.cards) - 1)]
+        return self._coalesce(
+            [row for (row, id) in enumerate(self.cards) if id in ids])
+
+    def _coalesce(self, rows):
+        "Turn a sorted list of rows into (top, bottom) ranges."
+        ranges = []
+        for row in rows:
+            if ranges and ranges[-1][1] == row - 1:
+                ranges[-1] = (ranges[-1][0], row)
+            else:
+                ranges.append((row, row))
+        return ranges
 
     # Column data
     ######################################################################
@@ -193,46 +719,118 @@ class DataModel(QAbstractTableModel):
         return type
 
     def columnData(self, index):
-        row = index.row()
-        col = index.column()
-        type = self.columnType(col)
-        c = self.getCard(index)
-        if type == "question":
-            return self.question(c)
-        elif type == "answer":
-            return self.answer(c)
-        elif type == "noteFld":
-            f = c.note()
-            return self.formatQA(f.fields[self.col.models.sortIdx(f.model())])
+        r = self.getRow(index)
+        if r is None:
+            return
+        return self.columnText(self.columnType(index.column()), r)
+
+    def columnText(self, type, r):
+        "The text of column TYPE for BrowserRow R."
+        if type in self.textCols:
+            return self.displayText(type, r)
         elif type == "template":
-            return c.template()['name']
+            return self.templateName(r.mid, r.ord)
         elif type == "cardDue":
-            return self.nextDue(c, index)
+            return self.nextDue(r, None)
         elif type == "noteCrt":
-            return time.strftime("%Y-%m-%d", time.localtime(c.note().id/1000))
+            return self.date(r.nid/1000)
         elif type == "noteMod":
-            return time.strftime("%Y-%m-%d", time.localtime(c.note().mod))
+            return self.date(r.nmod)
         elif type == "cardMod":
-            return time.strftime("%Y-%m-%d", time.localtime(c.mod))
+            return self.date(r.mod)
         elif type == "cardReps":
-            return str(c.reps)
+            return str(r.reps)
         elif type == "cardLapses":
-            return str(c.lapses)
+            return str(r.lapses)
         elif type == "cardIvl":
-            if c.type == 0:
+            if r.type == 0:
                 return _("(new)")
-            return fmtTimeSpan(c.ivl*86400)
+            return fmtTimeSpan(r.ivl*86400)
         elif type == "cardEase":
-            if c.type == 0:
+            if r.type == 0:
                 return _("(new)")
-            return "%d%%" % (c.factor/10)
+            return "%d%%" % (r.factor/10)
         elif type == "deck":
-            return self.browser.mw.col.decks.name(c.did)
+            return self.deckName(r.did)
         elif type == "ndeck":
-            return self.browser.mw.col.decks.name(c.note().did)
+            return self.deckName(r.ndid)
+
+    def columnTexts(self, ids):
+        "The text of each active column for IDS, as {id: [text, ...]}."
+        texts = {}
+        for data in self.col.db.execute(BrowserRow.sql % ids2str(ids)):
+            r = BrowserRow(data)
+            texts[r.id] = [self.columnText(type, r)
+                           for type in self.activeCols]
+        return texts
+
+    # Lookups
+    ######################################################################
+    # Names and dates shown in many rows are worked out once and kept until
+    # the next search or reset, so painting a column is a dict lookup.
+
+    # every timezone's offset is a multiple of 15 minutes, so all times in
+    # a bucket fall on the same local date
+    dateBucket = 900
+
+    def clearLookups(self):
+        self._deckNames = {}
+        self._tmplNames = {}
+        self._sortIdxs = {}
+        self._dates = {}
+
+    def deckName(self, did):
+        name = self._deckNames.get(did)
+        if name is None:
+            name = self._deckNames[did] = self.col.decks.name(did)
+        return name
+
+    def templateName(self, mid, ord):
+        name = self._tmplNames.get((mid, ord))
+        if name is None:
+            name = self._tmplNames[(mid, ord)] = (
+                self.col.models.get(mid)['tmpls'][ord]['name'])
+        return name
+
+    def sortIdx(self, mid):
+        idx = self._sortIdxs.get(mid)
+        if idx is None:
+            mm = self.col.models
+            idx = self._sortIdxs[mid] = mm.sortIdx(mm.get(mid))
+        return idx
+
+    def date(self, t):
+        bucket = int(t) // self.dateBucket
+        txt = self._dates.get(bucket)
+        if txt is None:
+            txt = self._dates[bucket] = time.strftime(
+                "%Y-%m-%d", time.localtime(bucket*self.dateBucket))
+        return txt
+
+    # Display text
+    ######################################################################
+    # Columns showing note text are slow to render, so the formatted text is
+    # cached with the note and model modification times it was built from,
+    # and filled in for the rows around the viewport as they're loaded.
+
+    textCols = ("question", "answer", "noteFld")
+
+    def displayText(self, type, r):
+        "The formatted text of column TYPE for BrowserRow R."
+        ver = (r.nmod, self.col.models.get(r.mid)['mod'])
+        k = self.texts.get((type, r.id))
+        if not k or k[0] != ver:
+            if type == "noteFld":
+                txt = self.formatQA(splitFields(r.flds)[self.sortIdx(r.mid)])
+            elif type == "question":
+                txt = self.question(self._loadCard(r.id))
+            else:
+                txt = self.answer(self._loadCard(r.id))
+            k = self.texts[(type, r.id)] = (ver, txt)
+        return k[1]
 
     def question(self, c):
-        return self.formatQA(c.a())
+        return self.formatQA(c.q())
 
     def answer(self, c):
         return self.formatQA(c.a())
@@ -255,7 +853,165 @@ class DataModel(QAbstractTableModel):
             date = time.time() + ((c.due - self.col.sched.today)*86400)
         else:
             return _("(susp.)")
-        return time.strftime("%Y-%m-%d", time.localtime(date))
+        return self.date(date)
+
+# Sidebar cache
+######################################################################
+# The deck and tag names shown in the browser's sidebar are kept between
+# browser windows. Tags are dropped when tags are added or the collection
+# is reset; decks can be renamed, moved and deleted in several places, so
+# the deck tree is rebuilt whenever the list of deck names differs.
+
+sidebarCache = None
+
+class SidebarCache(object):
+
+    def __init__(self):
+        self.col = None
+        self.clear()
+        addHook("newTag", self.clearTags)
+        addHook("reset", self.clear)
+
+    def clear(self):
+        self.tags = None
+        self.decks = None
+        self.deckNames = None
+
+    def clearTags(self):
+        self.tags = None
+
+    def _check(self, col):
+        if col is not self.col:
+            self.col = col
+            self.clear()
+
+    def tagList(self, col):
+        self._check(col)
+        if self.tags is None:
+            self.tags = sorted(col.tags.all())
+        return self.tags
+
+    def deckTree(self, col):
+        "Nested (name, fullName, children) tuples, built from the names only."
+        self._check(col)
+        names = col.decks.allNames()
+        if names != self.deckNames:
+            self.deckNames = names
+            self.decks = []
+            children = {}
+            # parents sort before their children
+            for full in sorted(names, key=lambda n: n.lower()):
+                parts = full.split("::")
+                # attach to the closest parent that exists
+                for i in range(len(parts)-1, 0, -1):
+                    parent = children.get("::".join(parts[:i]).lower())
+                    if parent is not None:
+                        break
+                else:
+                    (i, parent) = (0, self.decks)
+                node = ("::".join(parts[i:]), full, [])
+                children[full.lower()] = node[2]
+                parent.append(node)
+        return self.decks
+
+# Search thread
+######################################################################
+
+class ReadOnlyCol(object):
+    "Wraps a collection so that searches use a different DB connection."
+
+    def __init__(self, col, db):
+        self._col = col
+        self.db = db
+
+    def __getattr__(self, key):
+        return getattr(self._col, key)
+
+class SearchThread(QThread):
+
+    def __init__(self, col, txt, full, query=None):
+        QThread.__init__(self)
+        self.col = col
+        self.txt = txt
+        self.full = full
+        self.query = query or txt
+        self.cancelled = False
+        self.result = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        db = DB(self.col.path)
+        # a true return value aborts the current query
+        db.set_progress_handler(lambda: self.cancelled, 10000)
+        try:
+            self.result = Finder(ReadOnlyCol(self.col, db)).findCards(
+                self.query, self.full)
+        except:
+            self.result = None
+        db.close()
+
+class DupeThread(QThread):
+    """Group notes whose fields match once formatting, whitespace and case
+are ignored, in one pass over the notes. ORDS maps each model id to the
+field to compare."""
+
+    # notes checked between updates of the report
+    updateEvery = 5000
+
+    def __init__(self, path, ords):
+        QThread.__init__(self)
+        self.path = path
+        self.ords = ords
+        self.cancelled = False
+        # (text, nids); grows as the search proceeds
+        self.groups = []
+        # traceback if the search failed
+        self.error = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        db = DB(self.path)
+        db.set_progress_handler(lambda: self.cancelled, 10000)
+        try:
+            self.scan(db)
+        except Exception:
+            # cancelling interrupts the query
+            if not self.cancelled:
+                self.error = unicode(
+                    traceback.format_exc(), "ascii", "replace")
+        finally:
+            db.close()
+
+    def scan(self, db):
+        if not self.ords:
+            return
+        # the first note for each hash, then its group once there's another
+        seen = {}
+        cnt = 0
+        for (nid, mid, flds) in db.execute(
+            "select id, mid, flds from notes where mid in %s" %
+            ids2str(self.ords.keys())):
+            val = " ".join(stripHTMLMedia(
+                splitFields(flds)[self.ords[mid]]).split())
+            if val:
+                key = hashlib.sha1(val.lower().encode("utf8")).digest()
+                first = seen.get(key)
+                if first is None:
+                    seen[key] = nid
+                elif isinstance(first, list):
+                    first.append(nid)
+                else:
+                    group = seen[key] = [first, nid]
+                    self.groups.append((val, group))
+            cnt += 1
+            if not cnt % self.updateEvery:
+                if self.cancelled:
+                    return
+                self.emit(SIGNAL("groupsFound"))
 
 # Line painter
 ######################################################################
@@ -268,18 +1024,18 @@ class StatusDelegate(QItemDelegate):
 
     def paint(self, painter, option, index):
         try:
-            c = self.model.getCard(index)
-        except:
+            f = self.model.flags[index.row()]
+        except IndexError:
             # in the the middle of a reset; return nothing so this row is not
             # rendered until we have a chance to reset the model
             return
-        if c.queue < 0:
+        if f & (FLAG_SUSPENDED | FLAG_BURIED):
             # custom render
             brush = QBrush(QColor(COLOUR_SUSPENDED))
             painter.save()
             painter.fillRect(option.rect, brush)
             painter.restore()
-        elif c.note().hasTag("Marked"):
+        elif f & FLAG_MARKED:
             brush = QBrush(QColor(COLOUR_MARKED))
             painter.save()
             painter.fillRect(option.rect, brush)
@@ -309,6 +1065,9 @@ class Browser(QMainWindow):
         self.form.splitter_2.setChildrenCollapsible(False)
         self.form.splitter.setChildrenCollapsible(False)
         self.card = None
+        self._selection = None
+        # search whose results should all be selected when they arrive
+        self._selectAllFor = None
         self.setupToolbar()
         self.setupColumns()
         self.setupTable()
@@ -347,6 +1106,7 @@ class Browser(QMainWindow):
         c(f.actionSelectNotes, s, self.selectNotes)
         c(f.actionFindReplace, s, self.onFindReplace)
         c(f.actionFindDuplicates, s, self.onFindDupes)
+        c(f.actionExport, s, self.onExport)
         # jumps
         c(f.actionPreviousCard, s, self.onPreviousCard)
         c(f.actionNextCard, s, self.onNextCard)
@@ -374,6 +1134,7 @@ class Browser(QMainWindow):
         saveState(self, "editor")
         saveHeader(self.form.tableView.horizontalHeader(), "editor")
         self.col.conf['activeCols'] = self.model.activeCols
+        self.model.cancelSearch(wait=True)
         self.hide()
         aqt.dialogs.close("Browser")
         self.teardownHooks()
@@ -418,6 +1179,9 @@ class Browser(QMainWindow):
         self.connect(self.form.searchEdit,
                      SIGNAL("returnPressed()"),
                      self.onSearch)
+        self.connect(self.form.searchEdit,
+                     SIGNAL("textEdited(QString)"),
+                     self.onSearchEdited)
         self.setTabOrder(self.form.searchEdit, self.form.tableView)
         self.compModel = QStringListModel()
         self.compModel.setStringList(self.mw.pm.profile['searchHistory'])
@@ -426,8 +1190,23 @@ class Browser(QMainWindow):
         self.searchComp.setCaseSensitivity(Qt.CaseInsensitive)
         self.form.searchEdit.setCompleter(self.searchComp)
 
+    def onSearchEdited(self, txt):
+        # wait until the user stops typing
+        if self.filterTimer:
+            self.filterTimer.stop()
+        self.filterTimer = self.mw.progress.timer(300, self.onLiveSearch, False)
+
+    def onLiveSearch(self):
+        self.filterTimer = None
+        txt = unicode(self.form.searchEdit.text()).strip()
+        if txt != self.model.lastSearch:
+            self.model.search(txt)
+
     def onSearch(self, reset=True):
         "Careful: if reset is true, the current note is saved."
+        if self.filterTimer:
+            self.filterTimer.stop()
+            self.filterTimer = None
         txt = unicode(self.form.searchEdit.text()).strip()
         sh = self.mw.pm.profile['searchHistory']
         if txt not in sh:
@@ -436,6 +1215,12 @@ class Browser(QMainWindow):
             self.compModel.setStringList(sh)
             self.mw.pm.profile['searchHistory'] = sh
         self.model.search(txt, reset)
+
+    def onSearchDone(self):
+        txt = self._selectAllFor
+        self._selectAllFor = None
+        if txt is not None and txt == self.model.lastSearch:
+            self.form.tableView.selectAll()
         if not self.model.cards:
             # no row change will fire
             self.onRowChanged(None, None)
@@ -449,7 +1234,8 @@ class Browser(QMainWindow):
             # tooltip(txt)
 
     def updateTitle(self):
-        selected = len(self.form.tableView.selectionModel().selectedRows())
+        selected = sum([bottom - top + 1 for (top, bottom) in
+                        self.selectedRanges()])
         cur = len(self.model.cards)
         self.setWindowTitle(ngettext("Browser (%(cur)d card shown; %(sel)s)",
                                      "Browser (%(cur)d cards shown; %(sel)s)",
@@ -461,6 +1247,11 @@ class Browser(QMainWindow):
 
     def onReset(self):
         self.editor.setNote(None)
+        # decks and models may have been renamed
+        self.model.clearLookups()
+        # undo rolls back the selcards table too
+        self._selection = None
+        self.buildTree()
         self.onSearch()
 
     # Table view & editor
@@ -493,7 +1284,6 @@ class Browser(QMainWindow):
             self.editor.setNote(self.card.note(reload=True))
             self.editor.card = self.card
         self.toolbar.draw()
-        self.buildTree()
 
     def refreshCurrentCard(self, note):
         self.model.refreshNote(note)
@@ -521,15 +1311,15 @@ class Browser(QMainWindow):
 
     def onSortChanged(self, idx, ord):
         type = self.model.activeCols[idx]
-        noSort = ("question", "answer", "template", "deck", "ndeck")
-        if type in noSort:
-            showInfo(_("Sorting on this column is not supported. Please "
-                       "choose another."))
-            type = self.col.conf['sortType']
-        if self.col.conf['sortType'] != type:
-            self.col.conf['sortType'] = type
+        if self.model.sortType() != type:
+            if type in self.model.localSorts:
+                # libanki's order is kept for ties
+                self.col.conf['browserSort'] = type
+            else:
+                self.col.conf['browserSort'] = None
+                self.col.conf['sortType'] = type
             # default to descending for non-text fields
-            if type == "noteFld":
+            if type == "noteFld" or type in self.model.localSorts:
                 ord = not ord
             self.col.conf['sortBackwards'] = ord
             self.onSearch()
@@ -541,7 +1331,7 @@ class Browser(QMainWindow):
 
     def setSortIndicator(self):
         hh = self.form.tableView.horizontalHeader()
-        type = self.col.conf['sortType']
+        type = self.model.sortType()
         if type not in self.model.activeCols:
             hh.setSortIndicatorShown(False)
             return
@@ -595,10 +1385,29 @@ class Browser(QMainWindow):
             QTreeWidgetItem.__init__(self, [name])
             self.onclick = onclick
 
+    class FilterItem(QTreeWidgetItem):
+        "An item that searches for FILTER, and may load children on expand."
+        def __init__(self, name, filter=None, icon=None):
+            QTreeWidgetItem.__init__(self, [name])
+            self.filter = filter
+            self.loadChildren = None
+            if icon:
+                self.setIcon(0, QIcon(":/icons/" + icon))
+
+        def setLoader(self, func):
+            self.loadChildren = func
+            self.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+
     def setupTree(self):
+        global sidebarCache
+        if not sidebarCache:
+            sidebarCache = SidebarCache()
         self.connect(
             self.form.tree, SIGNAL("itemClicked(QTreeWidgetItem*,int)"),
             self.onTreeClick)
+        self.connect(
+            self.form.tree, SIGNAL("itemExpanded(QTreeWidgetItem*)"),
+            self.onTreeExpanded)
         p = QPalette()
         p.setColor(QPalette.Base, QColor("#d6dde0"))
         self.form.tree.setPalette(p)
@@ -613,13 +1422,24 @@ class Browser(QMainWindow):
         self._systemTagTree(root)
         self._decksTree(root)
         self._modelTree(root)
-        self._userTagTree(root)
-        self.form.tree.expandToDepth(0)
+        tags = self._userTagTree(root)
+        # the tag list stays collapsed until needed
+        for i in range(root.childCount()):
+            if root.child(i) is not tags:
+                root.child(i).setExpanded(True)
         self.form.tree.setIndentation(15)
 
     def onTreeClick(self, item, col):
         if getattr(item, 'onclick', None):
             item.onclick()
+        elif getattr(item, 'filter', None):
+            self.setFilter(*item.filter)
+
+    def onTreeExpanded(self, item):
+        load = getattr(item, 'loadChildren', None)
+        if load:
+            item.loadChildren = None
+            load()
 
     def setFilter(self, *args):
         if len(args) == 1:
@@ -664,24 +1484,26 @@ class Browser(QMainWindow):
         return root
 
     def _userTagTree(self, root):
-        for t in sorted(self.col.tags.all()):
-            item = self.CallbackItem(
-                t, lambda t=t: self.setFilter("tag", t))
-            item.setIcon(0, QIcon(":/icons/anki-tag.png"))
-            root.addChild(item)
+        tags = sidebarCache.tagList(self.col)
+        item = self.FilterItem(_("Tags"), icon="anki-tag.png")
+        if tags:
+            def load():
+                for t in tags:
+                    item.addChild(self.FilterItem(
+                        t, ("tag", t), "anki-tag.png"))
+            item.setLoader(load)
+        root.addChild(item)
+        return item
 
     def _decksTree(self, root):
-        grps = self.col.sched.deckDueTree()
-        def fillGroups(root, grps, head=""):
-            for g in grps:
-                item = self.CallbackItem(
-                g[0], lambda g=g: self.setFilter(
-                    "deck", head+g[0]))
-                item.setIcon(0, QIcon(":/icons/deck16.png"))
-                root.addChild(item)
-                newhead = head + g[0]+"::"
-                fillGroups(item, g[4], newhead)
-        fillGroups(root, grps)
+        def addDecks(parent, decks):
+            for (name, full, children) in decks:
+                item = self.FilterItem(name, ("deck", full), "deck16.png")
+                if children:
+                    item.setLoader(
+                        lambda item=item, c=children: addDecks(item, c))
+                parent.addChild(item)
+        addDecks(root, sidebarCache.deckTree(self.col))
 
     def _modelTree(self, root):
         for m in sorted(self.col.models.all(), key=itemgetter("name")):
@@ -703,13 +1525,39 @@ class Browser(QMainWindow):
         if not self.card:
             return
         info, cs = self._cardInfoData()
-        reps = self._revlogData(cs)
+        self._showRevlog(cs, info + "<p>")
+
+    def _showRevlog(self, cs, header=""):
         d = QDialog(self)
         l = QVBoxLayout()
         l.setMargin(0)
         w = AnkiWebView()
         l.addWidget(w)
-        w.stdHtml(info + "<p>" + reps)
+        reps, more = self._revlogData(cs)
+        # further pages are added as the user scrolls down
+        state = dict(offset=self.revlogPage, more=more)
+        def onLink(url):
+            if url != "revlog" or not state['more']:
+                return
+            rows, state['more'] = self._revlogRows(cs, state['offset'])
+            state['offset'] += self.revlogPage
+            w.eval("$('#revlog').append(%s); revlogMore = %s; revlogCheck();"
+                   % (simplejson.dumps(rows),
+                      "true" if state['more'] else "false"))
+        w.setLinkHandler(onLink)
+        w.stdHtml(header + reps, head="""
+<script>
+var revlogMore = %s;
+function revlogCheck() {
+    if (revlogMore && $(window).scrollTop() + $(window).height() >
+        $(document).height() - 100) {
+        revlogMore = false;
+        py.link("revlog");
+    }
+}
+$(window).scroll(revlogCheck);
+</script>""" % ("true" if more else "false"),
+                  loadCB=lambda w: w.eval("revlogCheck();"))
         bb = QDialogButtonBox(QDialogButtonBox.Close)
         l.addWidget(bb)
         bb.connect(bb, SIGNAL("rejected()"), d, SLOT("reject()"))
@@ -751,51 +1599,48 @@ border: 1px solid #000; padding: 3px; '>%s</div>""" % rep
             self.onSearch()
 
     def onRevlog(self):
-        data = self._revlogData()
-        d = QDialog(self)
-        l = QVBoxLayout()
-        l.setMargin(0)
-        w = AnkiWebView()
-        l.addWidget(w)
-        w.stdHtml(data)
-        bb = QDialogButtonBox(QDialogButtonBox.Close)
-        l.addWidget(bb)
-        bb.connect(bb, SIGNAL("rejected()"), d, SLOT("reject()"))
-        d.setLayout(l)
-        d.setWindowModality(Qt.WindowModal)
-        d.resize(500, 400)
-        restoreGeom(d, "revlog")
-        d.exec_()
-        saveGeom(d, "revlog")
+        from anki.stats import CardStats
+        self._showRevlog(CardStats(self.col, self.card))
+
+    # reviews shown at a time in the card history
+    revlogPage = 100
 
     def _revlogData(self, cs):
-        entries = self.mw.col.db.all(
-            "select id/1000.0, ease, ivl, factor, time/1000.0, type "
-            "from revlog where cid = ?", self.card.id)
-        if not entries:
-            return ""
+        "The first page of the card's history, and true if there's more."
+        rows, more = self._revlogRows(cs, 0)
+        if not rows:
+            return "", False
         s = "<table width=100%%><tr><th align=left>%s</th>" % _("Date")
         s += ("<th align=right>%s</th>" * 5) % (
             _("Type"), _("Ease"), _("Interval"), _("Factor"), _("Time"))
-        cnt = 0
-        for (date, ease, ivl, factor, taken, type) in reversed(entries):
-            cnt += 1
-            s += "<tr><td>%s</td>" % time.strftime(_("<b>%Y-%m-%d</b> @ %H:%M"),
-                                                   time.localtime(date))
-            tstr = [_("Learn"), _("Review"), _("Relearn"), _("Cram"),
-                    _("Resched")][type]
-            import anki.stats as st
-            fmt = "<span style='color:%s'>%s</span>"
-            if type == 0:
-                tstr = fmt % (st.colLearn, tstr)
-            elif type == 1:
-                tstr = fmt % (st.colMature, tstr)
-            elif type == 2:
-                tstr = fmt % (st.colRelearn, tstr)
-            elif type == 3:
-                tstr = fmt % (st.colCram, tstr)
-            else:
-                tstr = fmt % ("#000", tstr)
+        s += "<tbody id=revlog>" + rows + "</tbody></table>"
+        cnt = self.col.db.scalar(
+            "select count() from revlog where cid = ?", self.card.id)
+        if cnt != self.card.reps:
+            s += '<div style="font-size: 12px;">' + _("""\
+Note: Some of the history is missing. For more information, \
+please see the browser documentation.""") + "</div>"
+        return s, more
+
+    def _revlogRows(self, cs, offset):
+        """Table rows for a page of the card's reviews starting at OFFSET,
+newest first, and true if there are more."""
+        import anki.stats as st
+        # fetch one extra row to tell if there's another page
+        entries = self.col.db.all(
+            "select id/1000.0, ease, ivl, factor, time/1000.0, type "
+            "from revlog where cid = ? order by id desc limit ? offset ?",
+            self.card.id, self.revlogPage+1, offset)
+        more = len(entries) > self.revlogPage
+        types = [_("Learn"), _("Review"), _("Relearn"), _("Cram"),
+                 _("Resched")]
+        colours = [st.colLearn, st.colMature, st.colRelearn, st.colCram,
+                   "#000"]
+        fmt = "<span style='color:%s'>%s</span>"
+        buf = []
+        for (date, ease, ivl, factor, taken, type) in (
+            entries[:self.revlogPage]):
+            tstr = fmt % (colours[type], types[type])
             if ease == 1:
                 ease = fmt % (st.colRelearn, ease)
             if ivl == 0:
@@ -804,44 +1649,72 @@ border: 1px solid #000; padding: 3px; '>%s</div>""" % rep
                 ivl = fmtTimeSpan(ivl*86400, short=True)
             else:
                 ivl = cs.time(-ivl)
-            s += ("<td align=right>%s</td>" * 5) % (
+            buf.append("<tr><td>%s</td>" % time.strftime(
+                _("<b>%Y-%m-%d</b> @ %H:%M"), time.localtime(date)))
+            buf.append(("<td align=right>%s</td>" * 5) % (
                 tstr,
                 ease, ivl,
                 "%d%%" % (factor/10) if factor else "",
-                cs.time(taken)) + "</tr>"
-        s += "</table>"
-        if cnt != self.card.reps:
-            s += '<div style="font-size: 12px;">' + _("""\
-Note: Some of the history is missing. For more information, \
-please see the browser documentation.""") + "</div>"
-        return s
+                cs.time(taken)) + "</tr>")
+        return "".join(buf), more
 
     # Menu helpers
     ######################################################################
 
+    def selectedRanges(self):
+        "Sorted, non-overlapping (top, bottom) ranges of selected rows."
+        ranges = sorted([(r.top(), r.bottom()) for r in
+                         self.form.tableView.selectionModel().selection()])
+        merged = []
+        for (top, bottom) in ranges:
+            if merged and top <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(bottom, merged[-1][1]))
+            else:
+                merged.append((top, bottom))
+        return merged
+
     def selectedCards(self):
-        return [self.model.cards[idx.row()] for idx in
-                self.form.tableView.selectionModel().selectedRows()]
+        cards = []
+        for (top, bottom) in self.selectedRanges():
+            cards.extend(self.model.cards[top:bottom+1])
+        return cards
+
+    def loadSelection(self):
+        """Store the selected card ids in the selcards table, so queries can
+        join against it instead of building a long list of ids each time."""
+        ranges = self.selectedRanges()
+        cards = self.model.cards.snapshot()
+        if (self._selection and self._selection[0] == cards and
+            self._selection[1] == ranges):
+            return
+        # temp table changes needn't be saved, so leave the mod flag alone
+        mod = self.col.db.mod
+        self.col.db.execute("delete from selcards")
+        self.col.db.executemany(
+            "insert into selcards values (?)",
+            [(id,) for id in self.selectedCards()])
+        self.col.db.mod = mod
+        self._selection = (cards, ranges)
 
     def selectedNotes(self):
+        self.loadSelection()
         return self.col.db.list("""
-select distinct nid from cards
-where id in %s""" % ids2str(
-    [self.model.cards[idx.row()] for idx in
-    self.form.tableView.selectionModel().selectedRows()]))
+select distinct c.nid from selcards s, cards c
+where c.id = s.id""")
 
     def selectedNotesAsCards(self):
-        return self.col.db.list(
-            "select id from cards where nid in (%s)" %
-            ",".join([str(s) for s in self.selectedNotes()]))
+        self.loadSelection()
+        return self.col.db.list("""
+select id from cards where nid in
+(select c.nid from selcards s, cards c where c.id = s.id)""")
 
     def oneModelNotes(self):
         sf = self.selectedNotes()
         if not sf:
             return
         mods = self.col.db.scalar("""
-select count(distinct mid) from notes
-where id in %s""" % ids2str(sf))
+select count(distinct n.mid) from selcards s, cards c, notes n
+where c.id = s.id and n.id = c.nid""")
         if mods > 1:
             showInfo(_("Please select cards from only one model."))
             return
@@ -903,26 +1776,35 @@ where id in %s""" % ids2str(sf))
         te.setFocus()
 
     def _onSetDeck(self, frm, te):
-        self.model.beginReset()
+        self.editor.saveNow()
         self.mw.checkpoint(_("Set Deck"))
         mod = intTime()
         usn = self.col.usn()
+        cids = self.selectedCards()
         if frm.setCur.isChecked():
             did = self.col.decks.id(unicode(te.text()))
-            self.col.db.execute(
-                "update cards set usn=?, mod=?, did=? where id in " + ids2str(
-                    self.selectedCards()), usn, mod, did)
-            if frm.setInitial.isChecked():
+            def setCards(ids):
+                self.col.db.execute(
+                    "update cards set usn=?, mod=?, did=? where id in " +
+                    ids2str(ids), usn, mod, did)
+            def setNotes(ids):
                 self.col.db.execute(
-                    "update notes set usn=?, mod=?, did=? where id in " + ids2str(
-                        self.selectedNotes()), usn, mod, did)
+                    "update notes set usn=?, mod=?, did=? where id in " +
+                    ids2str(ids), usn, mod, did)
+            if not self.bulkEdit(cids, setCards):
+                return
+            if frm.setInitial.isChecked():
+                if not self.bulkEdit(self.selectedNotes(), setNotes):
+                    return
         else:
-            self.col.db.execute("""
+            def resetCards(ids):
+                self.col.db.execute("""
 update cards set usn=?, mod=?, did=(select did from notes where id = cards.nid)
-where id in %s""" % ids2str(self.selectedCards()), usn, mod)
-        self.onSearch(reset=False)
-        self.mw.requireReset()
-        self.model.endReset()
+where id in %s""" % ids2str(ids), usn, mod)
+            if not self.bulkEdit(cids, resetCards):
+                return
+        self.afterBulkEdit(cids, ("deck",),
+                           ("deck", "ndeck", "noteMod", "cardMod"))
 
     # Tags
     ######################################################################
@@ -940,12 +1822,17 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
             func = self.col.tags.bulkAdd
         if label is None:
             label = _("Add Tags")
+        # save the editor first, so cancelling can't undo its changes
+        self.editor.saveNow()
         if label:
             self.mw.checkpoint(label)
-        self.model.beginReset()
-        func(self.selectedNotes(), tags)
-        self.model.endReset()
-        self.mw.requireReset()
+        nids = self.selectedNotes()
+        # we can only cancel if there's a checkpoint to return to
+        if not self.bulkEdit(nids, lambda ids: func(ids, tags),
+                             cancellable=bool(label)):
+            return
+        self.afterBulkEdit(
+            self.selectedNotesAsCards(), ("tag",), ("noteMod",))
 
     def deleteTags(self, tags=None, label=None):
         if label is None:
@@ -966,11 +1853,14 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
         self.editor.saveNow()
         c = self.selectedCards()
         if sus:
-            self.col.sched.suspendCards(c)
+            self.mw.checkpoint(_("Suspend"))
+            func = self.col.sched.suspendCards
         else:
-            self.col.sched.unsuspendCards(c)
-        self.model.reset()
-        self.mw.requireReset()
+            self.mw.checkpoint(_("Unsuspend"))
+            func = self.col.sched.unsuspendCards
+        if not self.bulkEdit(c, func):
+            return
+        self.afterBulkEdit(c, ("is",), ("cardMod",))
 
     def isMarked(self):
         return not not (self.card and self.card.note().hasTag("Marked"))
@@ -987,9 +1877,9 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
     ######################################################################
 
     def reposition(self):
-        cids = self.selectedCards()
-        cids = self.col.db.list(
-            "select id from cards where type = 0 and id in " + ids2str(cids))
+        self.loadSelection()
+        cids = self.col.db.list("""
+select c.id from selcards s, cards c where c.id = s.id and c.type = 0""")
         if not cids:
             return showInfo(_("Only new cards can be repositioned."))
         d = QDialog(self)
@@ -1003,14 +1893,15 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
         frm.label.setText(txt)
         if not d.exec_():
             return
-        self.model.beginReset()
+        self.editor.saveNow()
         self.mw.checkpoint(_("Reposition"))
         self.col.sched.sortCards(
             cids, start=frm.start.value(), step=frm.step.value(),
             shuffle=frm.randomize.isChecked(), shift=frm.shift.isChecked())
-        self.onSearch(reset=False)
-        self.mw.requireReset()
-        self.model.endReset()
+        if frm.shift.isChecked():
+            # other new cards were moved too
+            cids = None
+        self.afterBulkEdit(cids, ("is", "prop"), ("cardDue", "cardMod"))
 
     # Rescheduling
     ######################################################################
@@ -1022,16 +1913,66 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
         frm.setupUi(d)
         if not d.exec_():
             return
-        self.model.beginReset()
+        self.editor.saveNow()
         self.mw.checkpoint(_("Reschedule"))
+        cids = self.selectedCards()
         if frm.asNew.isChecked():
-            self.col.sched.forgetCards(self.selectedCards())
+            func = self.col.sched.forgetCards
         else:
-            self.col.sched.reschedCards(
-                self.selectedCards(), frm.min.value(), frm.max.value())
-        self.onSearch(reset=False)
+            func = lambda ids: self.col.sched.reschedCards(
+                ids, frm.min.value(), frm.max.value())
+        if not self.bulkEdit(cids, func):
+            return
+        self.afterBulkEdit(cids, ("is", "prop"), (
+            "cardDue", "cardIvl", "cardEase", "cardMod"))
+
+    # Bulk edits
+    ######################################################################
+    # Edits to many cards are applied in fixed-size chunks, so statements
+    # stay small and the progress window can update between them. The
+    # chunks share the transaction started by the caller's checkpoint, so
+    # cancelling simply undoes back to that checkpoint.
+
+    bulkChunkSize = 1000
+
+    def bulkEdit(self, ids, func, cancellable=True):
+        "Call FUNC on chunks of IDS. False if the user cancelled."
+        chunk = self.bulkChunkSize
+        self.mw.progress.start(max=len(ids), cancellable=cancellable)
+        try:
+            for i in range(0, len(ids), chunk):
+                func(ids[i:i+chunk])
+                self.mw.progress.update(value=min(i+chunk, len(ids)))
+                if self.mw.progress.wantCancel():
+                    break
+            else:
+                return True
+        finally:
+            self.mw.progress.finish()
+        self.mw.onUndo()
+        tooltip(_("Cancelled."))
+        return False
+
+    # Refreshing after edits
+    ######################################################################
+
+    def afterBulkEdit(self, cids, keys, sorts):
+        """Update the table after modifying CIDS. If the search results may
+have changed (see DataModel.mayChange()), or CIDS is None, search again;
+otherwise just redraw the modified rows."""
+        if cids is None or self.model.mayChange(keys, sorts):
+            self.model.beginReset()
+            self.onSearch(reset=False)
+            self.model.endReset()
+        else:
+            self.model.refreshCards(cids)
+            if self.card and self.updateTitle() == 1:
+                # the editor may be showing stale tags or deck
+                self.card.load()
+                self.editor.setNote(self.card.note(reload=True))
+                self.editor.card = self.card
+            self.toolbar.draw()
         self.mw.requireReset()
-        self.model.endReset()
 
     # Edit: selection
     ######################################################################
@@ -1042,8 +1983,9 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
         # clear the selection so we don't waste energy preserving it
         tv = self.form.tableView
         tv.selectionModel().clear()
+        # the search may finish in the background
+        self._selectAllFor = unicode(self.form.searchEdit.text()).strip()
         self.onSearch()
-        tv.selectAll()
 
     def invertSelection(self):
         sm = self.form.tableView.selectionModel()
@@ -1059,9 +2001,11 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
         addHook("reset", self.onReset)
         addHook("editTimer", self.refreshCurrentCard)
         addHook("editFocusLost", self.refreshCurrentCard)
+        addHook("newTag", self.buildTree)
 
     def teardownHooks(self):
         remHook("reset", self.onReset)
+        remHook("newTag", self.buildTree)
         remHook("editTimer", self.refreshCurrentCard)
         remHook("editFocusLost", self.refreshCurrentCard)
         remHook("undoState", self.onUndoState)
@@ -1083,6 +2027,7 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
         frm.fontSize.setValue(self.mw.pm.profile['editFontSize'])
         frm.lineSize.setValue(self.mw.pm.profile['editLineSize'])
         frm.fullSearch.setChecked(self.mw.pm.profile['fullSearch'])
+        frm.textIndex.setChecked(bool(self.mw.pm.profile.get('textIndex')))
         if d.exec_():
             self.mw.pm.profile['editFontFamily'] = (
                 unicode(frm.fontCombo.currentFont().family()))
@@ -1091,12 +2036,17 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
             self.mw.pm.profile['editLineSize'] = (
                 int(frm.lineSize.value()))
             self.mw.pm.profile['fullSearch'] = frm.fullSearch.isChecked()
+            self.mw.setTextIndexEnabled(frm.textIndex.isChecked())
             self.updateFont()
 
     # Edit: replacing
     ######################################################################
 
+    # changes shown before anything is written
+    previewChanges = 50
+
     def onFindReplace(self):
+        self.editor.saveNow()
         sf = self.selectedNotes()
         if not sf:
             return
@@ -1111,30 +2061,68 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
                      self.onFindReplaceHelp)
         if not d.exec_():
             return
+        src = unicode(frm.find.text())
+        dst = unicode(frm.replace.text())
+        if not frm.re.isChecked():
+            src = re.escape(src)
+        if frm.ignoreCase.isChecked():
+            src = "(?i)" + src
+        try:
+            regex = re.compile(src)
+        except sre_constants.error:
+            showInfo(_("Invalid regular expression."), parent=self)
+            return
         if frm.field.currentIndex() == 0:
-            field = None
+            ords = None
         else:
             field = fields[frm.field.currentIndex()-1]
-        self.mw.checkpoint(_("Find and Replace"))
-        self.mw.progress.start()
-        self.model.beginReset()
+            ords = {}
+            for m in self.col.models.all():
+                for f in m['flds']:
+                    if f['name'] == field:
+                        ords[str(m['id'])] = f['ord']
+        chunks = self._findReplaceChunks(sf, regex, dst, ords)
+        # find the first few changes and ask before writing anything
+        pending = []
+        scanned = 0
+        self.mw.progress.start(max=len(sf))
         try:
-            changed = self.col.findReplace(sf,
-                                            unicode(frm.find.text()),
-                                            unicode(frm.replace.text()),
-                                            frm.re.isChecked(),
-                                            field,
-                                            frm.ignoreCase.isChecked())
+            for (cnt, changes) in chunks:
+                scanned += cnt
+                pending.extend(changes)
+                self.mw.progress.update(value=scanned)
+                if len(pending) >= self.previewChanges:
+                    break
         except sre_constants.error:
-            ui.utils.showInfo(_("Invalid regular expression."),
-                              parent=self)
+            # an invalid group reference in the replacement
+            showInfo(_("Invalid regular expression."), parent=self)
             return
-        else:
-            self.onSearch()
-            self.mw.requireReset()
         finally:
-            self.model.endReset()
             self.mw.progress.finish()
+        changed = 0
+        if pending:
+            if not self._previewFindReplace(pending, scanned < len(sf)):
+                return
+            self.mw.checkpoint(_("Find and Replace"))
+            self.mw.progress.start(max=len(sf), cancellable=True)
+            try:
+                self._saveFindReplace(pending)
+                changed = len(pending)
+                self.mw.progress.update(value=scanned)
+                for (cnt, changes) in chunks:
+                    if self.mw.progress.wantCancel():
+                        break
+                    scanned += cnt
+                    self._saveFindReplace(changes)
+                    changed += len(changes)
+                    self.mw.progress.update(value=scanned)
+            finally:
+                self.mw.progress.finish()
+            if scanned < len(sf):
+                self.mw.onUndo()
+                tooltip(_("Cancelled."))
+                return
+            self.afterBulkEdit(None, (), ())
         showInfo(ngettext(
             "%(a)d of %(b)d note updated",
             "%(a)d of %(b)d notes updated", len(sf)) % {
@@ -1142,80 +2130,167 @@ where id in %s""" % ids2str(self.selectedCards()), usn, mod)
                 'b': len(sf),
             })
 
+    def _findReplaceChunks(self, nids, regex, dst, ords):
+        """Yield (count, changes) for each chunk of NIDS, where changes is a
+list of (nid, oldFlds, newFlds). If ORDS is provided, only replace in the
+field it maps each model id to."""
+        for i in range(0, len(nids), self.bulkChunkSize):
+            chunk = nids[i:i+self.bulkChunkSize]
+            changes = []
+            for (nid, mid, flds) in self.col.db.execute(
+                "select id, mid, flds from notes where id in %s" %
+                ids2str(chunk)):
+                sflds = splitFields(flds)
+                if ords is None:
+                    sflds = [regex.sub(dst, f) for f in sflds]
+                elif str(mid) in ords:
+                    ord = ords[str(mid)]
+                    sflds[ord] = regex.sub(dst, sflds[ord])
+                new = joinFields(sflds)
+                if new != flds:
+                    changes.append((nid, flds, new))
+            yield len(chunk), changes
+
+    def _saveFindReplace(self, changes):
+        if not changes:
+            return
+        mod = intTime()
+        usn = self.col.usn()
+        self.col.db.executemany(
+            "update notes set flds=?, mod=?, usn=? where id=?",
+            [(new, mod, usn, nid) for (nid, old, new) in changes])
+        nids = [c[0] for c in changes]
+        self.col.updateFieldCache(nids)
+        self.col.genCards(nids)
+
+    def _previewFindReplace(self, changes, partial):
+        "Show the first CHANGES and return true if the user accepts them."
+        rows = []
+        for (nid, old, new) in changes[:self.previewChanges]:
+            for (a, b) in zip(splitFields(old), splitFields(new)):
+                if a != b:
+                    rows.append("<tr><td>%s</td><td>%s</td></tr>" % (
+                        cgi.escape(a), cgi.escape(b)))
+        if partial or len(changes) > self.previewChanges:
+            msg = _("The first %d changes are shown below.") % (
+                min(len(changes), self.previewChanges))
+        else:
+            msg = ngettext("%d note will be updated.",
+                           "%d notes will be updated.", len(changes)) % (
+                len(changes))
+        diag = QDialog(self)
+        diag.setWindowTitle(_("Find and Replace"))
+        layout = QVBoxLayout(diag)
+        diag.setLayout(layout)
+        layout.addWidget(QLabel(msg))
+        text = QTextEdit()
+        text.setReadOnly(True)
+        text.setHtml("""
+<table width=100%% border=1 cellspacing=0 cellpadding=3>
+<tr><th>%s</th><th>%s</th></tr>%s</table>""" % (
+    _("Before"), _("After"), "".join(rows)))
+        layout.addWidget(text)
+        box = QDialogButtonBox(QDialogButtonBox.Ok|QDialogButtonBox.Cancel)
+        layout.addWidget(box)
+        diag.connect(box, SIGNAL("accepted()"), diag, SLOT("accept()"))
+        diag.connect(box, SIGNAL("rejected()"), diag, SLOT("reject()"))
+        diag.setMinimumHeight(400)
+        diag.setMinimumWidth(500)
+        return diag.exec_()
+
     def onFindReplaceHelp(self):
         openHelp("findreplace")
 
+    # Edit: exporting
+    ######################################################################
+
+    def onExport(self):
+        self.editor.saveNow()
+        if not self.model.cards:
+            return
+        from aqt.exporting import ExportCardsDialog
+        ExportCardsDialog(self)
+
     # Edit: finding dupes
     ######################################################################
 
     def onFindDupes(self):
-        return showInfo("not yet implemented")
+        import anki.find
+        self.editor.saveNow()
         win = QDialog(self)
-        aqt = ankiqt.forms.finddupes.Ui_Dialog()
-        dialog.setupUi(win)
+        frm = aqt.forms.finddupes.Ui_Dialog()
+        frm.setupUi(win)
         restoreGeom(win, "findDupes")
-        fields = sorted(self.card.note.model.fieldModels, key=attrgetter("name"))
-        # per-model data
-        data = self.col.db.all("""
-select fm.id, m.name || '>' || fm.name from fieldmodels fm, models m
-where fm.modelId = m.id""")
-        data.sort(key=itemgetter(1))
-        # all-model data
-        data2 = self.col.db.all("""
-select fm.id, fm.name from fieldmodels fm""")
-        byName = {}
-        for d in data2:
-            if d[1] in byName:
-                byName[d[1]].append(d[0])
-            else:
-                byName[d[1]] = [d[0]]
-        names = byName.keys()
-        names.sort()
-        alldata = [(byName[n], n) for n in names] + data
-        dialog.searchArea.addItems([d[1] for d in alldata])
+        fields = sorted(anki.find.fieldNames(self.col, downcase=False))
+        frm.searchArea.addItems(fields)
         # links
-        dialog.webView.page().setLinkDelegationPolicy(
+        frm.webView.page().setLinkDelegationPolicy(
             QWebPage.DelegateAllLinks)
-        self.connect(dialog.webView,
+        self.connect(frm.webView,
                      SIGNAL("linkClicked(QUrl)"),
                      self.dupeLinkClicked)
+        win.dupeThread = None
 
         def onFin(code):
+            if win.dupeThread:
+                win.dupeThread.cancel()
+                win.dupeThread.wait()
             saveGeom(win, "findDupes")
         self.connect(win, SIGNAL("finished(int)"), onFin)
 
         def onClick():
-            idx = dialog.searchArea.currentIndex()
-            data = alldata[idx]
-            if isinstance(data[0], list):
-                # all models
-                fmids = data[0]
-            else:
-                # single model
-                fmids = [data[0]]
-            self.duplicatesReport(dialog.webView, fmids)
-
-        self.connect(dialog.searchButton, SIGNAL("clicked()"),
+            if win.dupeThread:
+                win.dupeThread.cancel()
+                win.dupeThread.wait()
+            name = fields[frm.searchArea.currentIndex()]
+            # every model with a field of that name
+            ords = {}
+            for m in self.col.models.all():
+                for f in m['flds']:
+                    if f['name'] == name:
+                        ords[int(m['id'])] = f['ord']
+            win.dupeThread = self.duplicatesReport(frm.webView, ords)
+
+        self.connect(frm.searchButton, SIGNAL("clicked()"),
                      onClick)
         win.show()
 
-    def duplicatesReport(self, web, fmids):
-        self.col.startProgress(2)
-        self.col.updateProgress(_("Finding..."))
-        res = self.col.findDuplicates(fmids)
-        t = "<html><body>"
-        t += _("Duplicate Groups: %d") % len(res)
-        t += "<p><ol>"
-
-        for group in res:
-            t += '<li><a href="%s">%s</a>' % (
-                "nid:" + ",".join(str(id) for id in group[1]),
-                group[0])
-
-        t += "</ol>"
-        t += "</body></html>"
-        web.setHtml(t)
-        self.col.finishProgress()
+    def duplicatesReport(self, web, ords):
+        """Find notes whose ORDS fields match, showing groups in WEB as they
+are found. Returns the thread doing the search, if any."""
+        t = DupeThread(self.col.path, ords)
+        def update(done=False):
+            if t.cancelled:
+                return
+            groups = t.groups[:]
+            if done:
+                groups.sort(key=itemgetter(0))
+            buf = [_("Duplicate Groups: %d") % len(groups), "<p><ol>"]
+            for (txt, nids) in groups:
+                buf.append('<li><a href="%s">%s</a>' % (
+                    "nid:" + ",".join(str(id) for id in nids),
+                    cgi.escape(txt)))
+            buf.append("</ol>")
+            if t.error:
+                buf.append("<p>%s<pre>%s</pre>" % (
+                    _("The search failed:"), cgi.escape(t.error)))
+            elif not done:
+                buf.append("<p>" + _("Searching..."))
+            web.setHtml("<html><body>%s</body></html>" % "".join(buf))
+        if self.col.db.mod:
+            # the thread can't see unsaved changes
+            self.mw.progress.start(immediate=True)
+            try:
+                t.scan(self.col.db)
+            finally:
+                self.mw.progress.finish()
+            update(True)
+            return
+        self.connect(t, SIGNAL("groupsFound"), update)
+        self.connect(t, SIGNAL("finished()"), lambda: update(True))
+        update()
+        t.start()
+        return t
 
     def dupeLinkClicked(self, link):
         self.form.searchEdit.setText(link.toString())
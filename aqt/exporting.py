@@ -2,9 +2,11 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 from aqt.qt import *
+import os, csv, simplejson
 import anki, aqt, aqt.tagedit
 from aqt.utils import getSaveFile, tooltip
 from anki.exporting import exporters
+from anki.utils import ids2str, splitFields
 
 class ExportDialog(QDialog):
 
@@ -56,3 +58,155 @@ class ExportDialog(QDialog):
             self.mw.progress.finish()
             tooltip(_("%d exported.") % self.exporter.count)
         QDialog.accept(self)
+
+# Exporting browser results
+##########################################################################
+# The browser's cards are written out a chunk at a time, in the order
+# they're shown, so memory use doesn't grow with the number of cards.
+
+class CardExporter(object):
+    """Write the fields, tags, deck and card type of CIDS to a file. If MODEL
+is given, the text of the browser's active columns is added as well."""
+
+    chunkSize = 1000
+    # (name, extension)
+    formats = (("tsv", ".txt"), ("csv", ".csv"), ("json", ".json"))
+
+    def __init__(self, col, cids, format="tsv", includeTags=True,
+                 model=None):
+        self.col = col
+        self.cids = cids
+        self.format = format
+        self.includeTags = includeTags
+        self.model = model
+        self.count = 0
+        self._decks = {}
+
+    def exportInto(self, path, update=None):
+        """Write to PATH, calling UPDATE with the number of cards done after
+each chunk. If UPDATE returns true, stop and remove the partial file.
+Returns false if the export was stopped."""
+        file = open(path, "wb")
+        if self.format == "csv":
+            self._csv = csv.writer(file)
+        write = getattr(self, "_write" + self.format.capitalize())
+        self.count = 0
+        try:
+            for i in range(0, len(self.cids), self.chunkSize):
+                chunk = self.cids[i:i+self.chunkSize]
+                rows = {}
+                for r in self.col.db.execute("""
+select c.id, c.nid, c.did, c.ord, n.mid, n.flds, n.tags
+from cards c, notes n where c.nid = n.id and c.id in %s""" % ids2str(chunk)):
+                    rows[r[0]] = r
+                if self.model:
+                    texts = self.model.columnTexts(chunk)
+                for id in chunk:
+                    if id in rows:
+                        rec = self._record(rows[id])
+                        if self.model:
+                            rec['columns'] = dict(
+                                zip(self.model.activeCols, texts[id]))
+                        write(file, rec)
+                        self.count += 1
+                if update and update(i + len(chunk)):
+                    file.close()
+                    os.unlink(path)
+                    return False
+        finally:
+            if not file.closed:
+                file.close()
+        return True
+
+    def _record(self, row):
+        (id, nid, did, ord, mid, flds, tags) = row
+        if did not in self._decks:
+            self._decks[did] = self.col.decks.name(did)
+        tmpl = self.col.models.get(mid)['tmpls'][ord]['name']
+        rec = dict(id=id, nid=nid, deck=self._decks[did], card=tmpl,
+                   fields=splitFields(flds))
+        if self.includeTags:
+            rec['tags'] = tags.strip()
+        return rec
+
+    def _columns(self, rec):
+        cols = list(rec['fields'])
+        if self.includeTags:
+            cols.append(rec['tags'])
+        if self.model:
+            cols.extend(rec['columns'][type]
+                        for type in self.model.activeCols)
+        return cols
+
+    def _writeTsv(self, file, rec):
+        cols = [c.replace("\t", " ").replace("\n", "<br>")
+                for c in self._columns(rec)]
+        file.write(("\t".join(cols) + "\n").encode("utf8"))
+
+    def _writeCsv(self, file, rec):
+        self._csv.writerow([c.encode("utf8") for c in self._columns(rec)])
+
+    def _writeJson(self, file, rec):
+        file.write(simplejson.dumps(rec) + "\n")
+
+class ExportCardsDialog(QDialog):
+
+    def __init__(self, browser):
+        QDialog.__init__(self, browser)
+        self.browser = browser
+        self.mw = browser.mw
+        self.setWindowTitle(_("Export Cards"))
+        self.setWindowModality(Qt.WindowModal)
+        layout = QFormLayout(self)
+        self.scope = QComboBox()
+        self.scope.addItems([_("Selected cards"), _("All cards shown")])
+        if len(browser.selectedCards()) < 2:
+            self.scope.setCurrentIndex(1)
+        layout.addRow(_("Export:"), self.scope)
+        self.format = QComboBox()
+        self.format.addItems([
+            _("Tab separated text"), _("Comma separated (CSV)"),
+            _("JSON, one card per line")])
+        layout.addRow(_("Format:"), self.format)
+        self.includeTags = QCheckBox(_("Include tags"))
+        self.includeTags.setChecked(True)
+        layout.addRow(self.includeTags)
+        self.includeColumns = QCheckBox(_("Include the browser's columns"))
+        self.includeColumns.setChecked(True)
+        layout.addRow(self.includeColumns)
+        box = QDialogButtonBox(QDialogButtonBox.Cancel)
+        b = QPushButton(_("Export..."))
+        box.addButton(b, QDialogButtonBox.AcceptRole)
+        self.connect(box, SIGNAL("accepted()"), self, SLOT("accept()"))
+        self.connect(box, SIGNAL("rejected()"), self, SLOT("reject()"))
+        layout.addRow(box)
+        self.exec_()
+
+    def accept(self):
+        (format, ext) = CardExporter.formats[self.format.currentIndex()]
+        if self.scope.currentIndex() == 0:
+            cids = self.browser.selectedCards()
+        else:
+            cids = self.browser.model.cards
+        file = getSaveFile(
+            self, _("Choose file to export to"), "export",
+            _("Cards") + " (*%s)" % ext, ext)
+        if not file:
+            return
+        QDialog.accept(self)
+        model = None
+        if self.includeColumns.isChecked():
+            model = self.browser.model
+        exporter = CardExporter(
+            self.mw.col, cids, format, self.includeTags.isChecked(), model)
+        self.mw.progress.start(max=len(cids), cancellable=True,
+                               parent=self.browser)
+        try:
+            def update(done):
+                self.mw.progress.update(value=done)
+                return self.mw.progress.wantCancel()
+            ok = exporter.exportInto(file, update)
+        finally:
+            self.mw.progress.finish()
+        if ok:
+            tooltip(_("%d exported.") % exporter.count)
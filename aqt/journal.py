@@ -0,0 +1,94 @@
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import os, time
+
+# Review journal
+##########################################################################
+# Answers are committed to the collection in groups, so a crash could lose
+# the reviews since the last save. Each answer is also appended to a small
+# log that's synced to disk straight away, and emptied whenever the
+# collection is saved. Each entry has the id of the revlog row its answer
+# wrote; if the program exits without saving, answers whose rows never
+# reached the collection are applied again when it's next opened. Undoing
+# an answer appends an entry that cancels it.
+
+class ReviewJournal(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+
+    def close(self):
+        self.file.close()
+
+    def add(self, cid, ease, ts, taken, rid):
+        """Record an answer of EASE for CID, given at TS (ms) after TAKEN ms,
+which wrote revlog entry RID (0 if none)."""
+        self.file.write("%d %d %d %d %d\n" % (cid, ease, ts, taken, rid))
+        self._sync()
+
+    def remove(self, cid):
+        """Cancel the last answer to CID, after it has been undone. The log is
+only ever appended to, so a crash can't lose the other answers."""
+        for e in reversed(self.entries()):
+            if e[0] == cid:
+                self.file.write("%d %d %d %d -1\n" % e[:4])
+                self._sync()
+                return
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def clear(self):
+        "Empty the log; call after the collection has been saved."
+        if os.fstat(self.file.fileno()).st_size:
+            self.file.truncate(0)
+            self.file.flush()
+
+    def entries(self):
+        ret = []
+        for line in open(self.path, "rb"):
+            try:
+                (cid, ease, ts, taken, rid) = [int(x) for x in line.split()]
+            except ValueError:
+                # partly written when we crashed
+                continue
+            if rid == -1:
+                # an undo; drop the answer it cancels
+                for i in range(len(ret)-1, -1, -1):
+                    if ret[i][:4] == (cid, ease, ts, taken):
+                        del ret[i]
+                        break
+                continue
+            ret.append((cid, ease, ts, taken, rid))
+        return ret
+
+    def replay(self, col):
+        "Apply answers that never reached the collection. Returns the count."
+        entries = self.entries()
+        if not entries:
+            return 0
+        cnt = 0
+        col.sched.reset()
+        for (cid, ease, ts, taken, rid) in entries:
+            # already saved, or the card has since been deleted
+            if rid:
+                saved = col.db.scalar(
+                    "select 1 from revlog where id = ?", rid)
+            else:
+                # nothing was logged, so see if the card was saved since
+                saved = col.db.scalar(
+                    "select 1 from cards where id = ? and mod >= ?",
+                    cid, ts/1000)
+            if saved:
+                continue
+            if not col.db.scalar("select 1 from cards where id = ?", cid):
+                continue
+            card = col.getCard(cid)
+            card.timerStarted = time.time() - taken/1000.0
+            col.sched.answerCard(card, ease)
+            cnt += 1
+        col.sched.reset()
+        return cnt
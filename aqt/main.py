@@ -57,6 +57,8 @@ class AnkiQt(QMainWindow):
 
     def setupUI(self):
         self.col = None
+        self.textIndex = None
+        self.journal = None
         self.state = "overview"
         self.setupKeys()
         self.setupThreads()
@@ -226,6 +228,12 @@ Are you sure?"""):
     def loadCollection(self):
         self.col = Collection(self.pm.collectionPath())
         self.progress.setupDB(self.col.db)
+        # the browser's selection set; creating a table commits, so it
+        # needs to happen before there are any changes to undo
+        self.col.db.execute(
+            "create temp table selcards (id integer primary key)")
+        self.setupTextIndex()
+        self.setupJournal()
         # load overview if a single deck, otherwise deck list
         if self.col.decks.count() > 1:
             self.moveToState("deckBrowser")
@@ -235,11 +243,63 @@ Are you sure?"""):
     def unloadCollection(self):
         if self.col:
             self.closeAllCollectionWindows()
+            if self.textIndex:
+                self.textIndex.close()
+                self.textIndex = None
             self.maybeOptimize()
             self.col.close()
             self.col = None
+            # closing saved everything it recorded
+            self.journal.clear()
+            self.journal.close()
+            self.journal = None
             self.backup()
 
+    # Text index
+    ##########################################################################
+
+    def textIndexPath(self):
+        return os.path.join(self.pm.profileFolder(), "textindex.db")
+
+    def setupTextIndex(self):
+        if not self.pm.profile.get('textIndex'):
+            return
+        from aqt.textindex import TextIndex
+        new = not os.path.exists(self.textIndexPath())
+        self.textIndex = TextIndex(self, self.textIndexPath())
+        if new:
+            self.rebuildTextIndex()
+
+    def rebuildTextIndex(self):
+        self.progress.start(label=_("Indexing..."), immediate=True)
+        self.textIndex.rebuild(self.col)
+        self.progress.finish()
+
+    def setTextIndexEnabled(self, on):
+        self.pm.profile['textIndex'] = on
+        if on and not self.textIndex:
+            self.setupTextIndex()
+        elif not on and self.textIndex:
+            self.textIndex.remove()
+            self.textIndex = None
+
+    # Review journal
+    ##########################################################################
+
+    def setupJournal(self):
+        from aqt.journal import ReviewJournal
+        self.journal = ReviewJournal(
+            os.path.join(self.pm.profileFolder(), "reviews.log"))
+        if self.journal.replay(self.col):
+            self.col.save()
+        self.journal.clear()
+
+    def saveReviews(self):
+        "Save the collection, and the reviews recorded in the journal."
+        self.col.save()
+        self.journal.clear()
+        self.maybeEnableUndo()
+
     # Backup and auto-optimize
     ##########################################################################
 
@@ -315,6 +375,7 @@ Are you sure?"""):
 
     def _reviewCleanup(self, newState):
         print "rethink cleanup code?"
+        self.reviewer.stopIdleSave()
         if newState != "resetRequired":
             self.reviewer.cleanup()
 
@@ -629,6 +690,9 @@ Debug info:\n%s""") % traceback.format_exc(), help="DeckErrors")
 
     def onUndo(self):
         cid = self.col.undo()
+        if cid:
+            # a review was undone, so it mustn't be replayed
+            self.journal.remove(cid)
         if cid and self.state == "review":
             card = self.col.getCard(cid)
             self.reviewer.cardQueue.append(card)
@@ -835,6 +899,8 @@ Your edits have left some cards empty. Do you want to delete them?"""))
         "True if no problems"
         self.progress.start(immediate=True)
         ret = self.col.fixIntegrity()
+        if self.textIndex:
+            self.textIndex.rebuild(self.col)
         self.progress.finish()
         showText(ret)
         self.reset()
@@ -37,6 +37,7 @@ profileConf = dict(
 
     # editing
     fullSearch=False,
+    textIndex=False,
     searchHistory=[],
     recentColours=["#000000", "#0000ff"],
     stripHTML=True,
@@ -45,6 +46,12 @@ profileConf = dict(
     editLineSize=20,
     deleteMedia=False,
     preserveKeyboard=True,
+    browserCacheMB=20,
+    searchCacheMB=5,
+    # reload the review page after memory grows this much, or every
+    # webRecycleReps reviews if memory use can't be measured
+    webRecycleMB=64,
+    webRecycleReps=100,
 
     # syncing
     syncKey=None,
@@ -5,10 +5,11 @@
 import time, os, stat, shutil, difflib, simplejson, re
 import unicodedata as ucd
 from aqt.qt import *
-from anki.utils import fmtTimeSpan, stripHTML, isMac
+from anki.utils import fmtTimeSpan, stripHTML, isMac, intTime
 from anki.hooks import addHook, runHook, runFilter
 from anki.sound import playFromText, clearAudioQueue, hasSound
-from aqt.utils import mungeQA, getBase, shortcut, openLink, tooltip
+from aqt.utils import mungeQA, getBase, shortcut, openLink, tooltip, \
+    LRUCache, processMemory
 import aqt
 
 class Reviewer(object):
@@ -21,8 +22,16 @@ class Reviewer(object):
         self.cardQueue = []
         self.hadCardQueue = False
         self._answeredIds = []
+        self._prerendered = None
+        self._cardMemo = {}
+        # media files recently preloaded
+        self._preloaded = LRUCache(200)
         self.state = None
         self.bottom = aqt.toolbar.BottomBar(mw, mw.bottomWeb)
+        self._idleTimer = QTimer(mw)
+        self._idleTimer.setSingleShot(True)
+        self._idleTimer.connect(
+            self._idleTimer, SIGNAL("timeout()"), self._onIdle)
         addHook("leech", self.onLeech)
 
     def show(self):
@@ -36,6 +45,9 @@ class Reviewer(object):
             self.bottom.web.setFixedHeight(52)
         self.bottom.web.setLinkHandler(self._linkHandler)
         self._reps = None
+        if self.mw.col.db.mod:
+            # answers from before we left review may still be unsaved
+            self._idleTimer.start(self.saveIdle*1000)
         self.nextCard()
 
     def lastCard(self):
@@ -44,8 +56,12 @@ class Reviewer(object):
                 return self.mw.col.getCard(self._answeredIds[-1])
 
     def cleanup(self):
+        self.stopIdleSave()
         runHook("reviewCleanup")
 
+    def stopIdleSave(self):
+        self._idleTimer.stop()
+
     # Fetching a card
     ##########################################################################
 
@@ -63,12 +79,13 @@ class Reviewer(object):
                 self.hadCardQueue = False
             c = self.mw.col.sched.getCard()
         self.card = c
+        self._prerendered = None
+        self._cardMemo = {}
         clearAudioQueue()
         if not c:
             self.mw.moveToState("overview")
             return
-        if self._reps is None or self._reps % 100 == 0:
-            # we recycle the webview periodically so webkit can free memory
+        if self._reps is None:
             self._initWeb()
         else:
             self._showQuestion()
@@ -112,32 +129,84 @@ function _typeAnsPress() {
         py.link("ans");
     }
 }
+var _preloaded = [];
+function _preload (srcs) {
+    for (var i = 0; i < srcs.length; i++) {
+        var img = new Image();
+        img.src = srcs[i];
+        _preloaded.push(img);
+    }
+    // keeping a reference stops them being collected before they load
+    _preloaded = _preloaded.slice(-50);
+};
 </script>
 """
 
     def _initWeb(self):
         self._reps = 0
         self._bottomReady = False
-        base = getBase(self.mw.col)
         # main window
-        self.web.stdHtml(self._revHtml, self._styles(),
-            bodyClass="card", loadCB=lambda x: self._showQuestion(),
-            head=base)
+        self._loadWeb(lambda: self._showQuestion())
         # show answer / ease buttons
         self.bottom.web.stdHtml(
             self._bottomHTML(),
             self.bottom._css + self._bottomCSS,
         loadCB=lambda x: self._showAnswerButton())
 
+    def _loadWeb(self, cb):
+        self._webReps = 0
+        self._webMem = None
+        def onLoad(web):
+            self._webMem = processMemory()
+            cb()
+        self.web.stdHtml(self._revHtml, self._styles(),
+            bodyClass="card", loadCB=onLoad, head=getBase(self.mw.col))
+
+    # Recycling the webview
+    ##########################################################################
+    # Webkit only frees some memory when the page is reloaded. The review
+    # page is reloaded once the process has grown by webRecycleMB since the
+    # last load, or after webRecycleReps reviews if memory use can't be
+    # measured. Reloading happens while the answer is shown, when a short
+    # pause won't slow down moving to the next card, and leaves the bottom
+    # bar alone.
+
+    def _needsRecycle(self):
+        prof = self.mw.pm.profile
+        if self._webMem is not None:
+            mem = processMemory()
+            if mem is not None:
+                return (mem - self._webMem >
+                        prof.get('webRecycleMB', 64)*1024*1024)
+        return self._webReps >= prof.get('webRecycleReps', 100)
+
+    def _maybeRecycle(self):
+        if self.state != "answer" or not self._needsRecycle():
+            return
+        html = self._answerHtml
+        card = self.card
+        def restore():
+            # the user may have moved on while the page loaded
+            if self.card is card and self.state == "answer":
+                self.web.eval("_updateQA(%s, true);" % simplejson.dumps(html))
+            elif self.state == "question":
+                self.web.eval("_updateQA(%s);" % simplejson.dumps(
+                    self._questionHtml))
+        self._loadWeb(restore)
+
     # Showing the question
     ##########################################################################
 
     def _mungeQA(self, buf):
-        return self.mw.col.media.escapeImages(
-            self.typeAnsFilter(mungeQA(buf)))
+        return self.typeAnsFilter(self._prepareQA(buf))
+
+    def _prepareQA(self, buf):
+        "The parts of munging that don't depend on the typed answer."
+        return self.mw.col.media.escapeImages(mungeQA(buf))
 
     def _showQuestion(self):
         self._reps += 1
+        self._webReps += 1
         self.state = "question"
         c = self.card
         # grab the question and play audio
@@ -147,28 +216,111 @@ function _typeAnsPress() {
         # render & update bottom
         q = self._mungeQA(q)
         self.web.eval("_updateQA(%s);" % simplejson.dumps(q))
+        self._questionHtml = q
         if self._bottomReady:
             self._showAnswerButton()
         # if we have a type answer field, focus main web
         if self.typeCorrect:
             self.mw.web.setFocus()
+        # get the answer ready once the question has been drawn
+        QTimer.singleShot(100, self._prerenderAnswer)
         # user hook
         runHook('showQuestion')
 
+    # Pre-rendering the answer
+    ##########################################################################
+    # The scheduler can't tell us the next card without taking it off the
+    # queue, and which card is next depends on the answer. So instead, the
+    # current card's answer and ease buttons are prepared while the user
+    # looks at the question, and showing the answer just swaps them in.
+
+    def _prerenderKey(self):
+        return (self.card.id, self.card.note().mod)
+
+    def _prerenderAnswer(self):
+        if self.state != "question" or not self.card:
+            return
+        if self.mw.progress.inDB:
+            # not safe to query the DB now; the answer will be built on demand
+            return
+        c = self.card
+        a = c.a()
+        self._prerendered = dict(
+            key=self._prerenderKey(), card=c, a=a,
+            html=self._prepareQA(a), buttons=self._answerButtons())
+        self._preloadMedia()
+
+    # Preloading media
+    ##########################################################################
+    # Images on the answer side and on cards waiting in the card queue are
+    # loaded into webkit's cache ahead of time, and sound files are read so
+    # they're in the OS file cache when playback starts.
+
+    imgRegexp = re.compile(r"<img[^>]+src=[\"']?([^\"'>]+)", re.I)
+    soundRegexp = re.compile(r"\[sound:(.+?)\]")
+    # cards in the queue to look at
+    preloadCards = 3
+    # read at most this much of each sound file
+    preloadSoundBytes = 4*1024*1024
+
+    def _preloadMedia(self):
+        # (text, munged html)
+        texts = [(self._prerendered['a'], self._prerendered['html'])]
+        for c in self.cardQueue[-self.preloadCards:]:
+            q = c.q()
+            texts.append((q, self._prepareQA(q)))
+        imgs = []
+        for (txt, html) in texts:
+            for src in self.imgRegexp.findall(html):
+                if ("img", src) not in self._preloaded:
+                    self._preloaded[("img", src)] = True
+                    imgs.append(src)
+            for fname in self.soundRegexp.findall(txt):
+                if ("snd", fname) not in self._preloaded:
+                    self._preloaded[("snd", fname)] = True
+                    self._preloadSound(fname)
+        if imgs:
+            self.web.eval("_preload(%s);" % simplejson.dumps(imgs))
+
+    def _preloadSound(self, fname):
+        path = os.path.join(self.mw.col.media.dir(), fname)
+        try:
+            f = open(path, "rb")
+            f.read(self.preloadSoundBytes)
+            f.close()
+        except (IOError, OSError):
+            pass
+
+    def _takePrerendered(self):
+        "The prepared answer for the current card, if still valid."
+        p = self._prerendered
+        self._prerendered = None
+        if p and p['card'] is self.card and p['key'] == self._prerenderKey():
+            return p
+
     # Showing the answer
     ##########################################################################
 
     def _showAnswer(self):
         self.state = "answer"
         c = self.card
-        a = c.a()
+        p = self._takePrerendered()
+        if p:
+            a = p['a']
+        else:
+            a = c.a()
         # play audio?
         if self.mw.col.decks.confForDid(self.card.did)['autoplay']:
             playFromText(a)
         # render and update bottom
-        a = self._mungeQA(a)
+        if p:
+            a = self.typeAnsFilter(p['html'])
+        else:
+            a = self._mungeQA(a)
         self.web.eval("_updateQA(%s, true);" % simplejson.dumps(a))
-        self._showEaseButtons()
+        self._answerHtml = a
+        self._showEaseButtons(p and p['buttons'])
+        QTimer.singleShot(500, self._maybeRecycle)
         # user hook
         runHook('showAnswer')
 
@@ -179,13 +331,39 @@ function _typeAnsPress() {
         "Reschedule card and show next."
         if self.state != "answer":
             return
-        if self.mw.col.sched.answerButtons(self.card) < ease:
+        if self._buttonCount() < ease:
             return
+        ts = intTime(1000)
+        taken = self.card.timeTaken()
         self.mw.col.sched.answerCard(self.card, ease)
+        rid = self.mw.col.db.scalar(
+            "select max(id) from revlog where cid = ? and id >= ?",
+            self.card.id, ts) or 0
+        # the journal keeps the answer safe until the collection is saved
+        self.mw.journal.add(self.card.id, ease, ts, taken, rid)
         self._answeredIds.append(self.card.id)
-        self.mw.autosave()
+        if len(self._answeredIds) % self.saveEvery == 0:
+            self.mw.saveReviews()
+        else:
+            self.mw.autosave()
+            if not self.mw.col.db.mod:
+                # it was time for the regular save
+                self.mw.journal.clear()
+            self._idleTimer.start(self.saveIdle*1000)
         self.nextCard()
 
+    # save after this many answers, or this many seconds without one
+    saveEvery = 50
+    saveIdle = 30
+
+    def _onIdle(self):
+        # only while reviewing; the browser and other windows may be part
+        # way through changes they'll save or roll back themselves
+        if (self.mw.state != "review" or self.mw.progress.busy() or
+            self.mw.progress.inDB or not self.mw.col):
+            return
+        self.mw.saveReviews()
+
     # Handlers
     ############################################################
 
@@ -470,12 +648,37 @@ function showAnswer(txt) {
         self.bottom.web.eval("showQuestion(%s,%d);" % (
             simplejson.dumps(middle), maxTime))
 
-    def _showEaseButtons(self):
+    def _showEaseButtons(self, middle=None):
         self.bottom.web.setFocus()
-        middle = self._answerButtons()
+        middle = middle or self._answerButtons()
         self.bottom.web.eval("showAnswer(%s);" % simplejson.dumps(middle))
 
+    # Per-card memo
+    ##########################################################################
+    # The due counts and answer buttons are drawn more than once for each
+    # card, and can't change until it's answered, so they're only worked out
+    # from the scheduler once per card.
+
+    def _memo(self, key, func):
+        memo = self._cardMemo
+        if memo.get('card') is not self.card:
+            memo.clear()
+            memo['card'] = self.card
+        if key not in memo:
+            memo[key] = func()
+        return memo[key]
+
     def _remaining(self):
+        return self._memo("remaining", self._remainingText)
+
+    def _buttonCount(self):
+        return self._memo(
+            "buttonCount", lambda: self.mw.col.sched.answerButtons(self.card))
+
+    def _answerButtons(self):
+        return self._memo("answerButtons", self._answerButtonsHtml)
+
+    def _remainingText(self):
         if not self.mw.col.conf['dueCounts']:
             return ""
         if self.hadCardQueue:
@@ -492,13 +695,13 @@ function showAnswer(txt) {
         return ctxt
 
     def _defaultEase(self):
-        if self.mw.col.sched.answerButtons(self.card) == 4:
+        if self._buttonCount() == 4:
             return 3
         else:
             return 2
 
-    def _answerButtons(self):
-        if self.mw.col.sched.answerButtons(self.card) == 4:
+    def _answerButtonsHtml(self):
+        if self._buttonCount() == 4:
             labels = (_("Again"), _("Hard"), _("Good"), _("Easy"))
         else:
             labels = (_("Again"), _("Good"), _("Easy"))
@@ -0,0 +1,205 @@
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import os, re
+from anki.db import DB
+from anki.utils import ids2str
+from anki.hooks import addHook, remHook
+
+# Text index
+##########################################################################
+# An optional inverted index of the words in each note's raw fields, kept
+# in a separate file next to the collection. A plain search term that
+# contains only letters and digits can only match a note if it's part of
+# one of the note's words, so the index can narrow a search within
+# formatting down to a few candidate notes, which the normal search then
+# checks as usual.
+
+wordRe = re.compile(r"\w+", re.U)
+termRe = re.compile(r"^[^\W_]+$", re.U)
+
+def requiredTerms(query):
+    """The bare text terms every note matching QUERY must contain, or None if
+the query uses 'or' or grouping. QUERY is split the way the collection's
+search splits it; quoted, negated and field:value terms are left out, as
+they don't require their words to appear in the fields."""
+    # (text, quoted or negated)
+    tokens = []
+    token = ""
+    inQuote = False
+    skip = False
+    for c in query:
+        if c in ("'", '"'):
+            if inQuote:
+                if c == inQuote:
+                    inQuote = False
+                else:
+                    token += c
+            elif token and token[-1] != ":":
+                token += c
+            else:
+                # quotes are allowed to start directly after a :
+                inQuote = c
+                skip = True
+        elif c == " " and not inQuote:
+            # a lone - negates the next term
+            if token:
+                tokens.append((token, skip))
+                token = ""
+                skip = False
+        elif c in ("(", ")") and not inQuote:
+            return
+        elif c == "-" and not token:
+            skip = True
+        else:
+            token += c
+    if token:
+        tokens.append((token, skip))
+    terms = []
+    for (token, skip) in tokens:
+        if token.lower() == "or":
+            return
+        if not skip and ":" not in token and token.lower() != "and":
+            terms.append(token)
+    return terms
+
+schema = """
+create table if not exists words (id integer primary key, word text not null unique);
+create table if not exists postings (wid integer not null, nid integer not null);
+create table if not exists notes (id integer primary key, mod integer not null);
+create index if not exists ix_postings_wid on postings (wid);
+create index if not exists ix_postings_nid on postings (nid);
+"""
+
+class TextIndex(object):
+
+    # terms matching more words than this aren't selective enough to help
+    maxWords = 5000
+
+    def __init__(self, mw, path):
+        self.mw = mw
+        self.path = path
+        self.db = DB(path)
+        self.db.executescript(schema)
+        self._words = None
+        # notes may have changed since the index was last used
+        self.needsCheck = True
+        addHook("reset", self.onReset)
+
+    def close(self):
+        remHook("reset", self.onReset)
+        self.db.close()
+
+    def remove(self):
+        self.close()
+        os.unlink(self.path)
+
+    def onReset(self):
+        # undo and sync can revert notes to older versions, which the cheap
+        # check in update() won't notice
+        self.needsCheck = True
+
+    # Searching
+    ##########################################################################
+
+    def candidates(self, col, query):
+        "Return ids of notes that may match QUERY, or None if unknown."
+        terms = requiredTerms(query)
+        if not terms:
+            return
+        terms = [t.lower() for t in terms if termRe.match(t)]
+        if not terms:
+            return
+        self.update(col)
+        nids = None
+        for term in terms:
+            wids = self.db.list(
+                "select id from words where word like ?", "%"+term+"%")
+            if len(wids) > self.maxWords:
+                continue
+            found = set(self.db.list(
+                "select nid from postings where wid in %s" % ids2str(wids)))
+            if nids is None:
+                nids = found
+            else:
+                nids &= found
+        return nids
+
+    # Keeping up to date
+    ##########################################################################
+
+    def update(self, col):
+        "Reindex notes changed since the last update."
+        if self.needsCheck:
+            self.needsCheck = False
+            cur = dict(col.db.execute("select id, mod from notes"))
+        else:
+            # edits since the newest note we've indexed; notes changed in
+            # the same second as it are compared below. undo, sync and
+            # imports can leave older times, and trigger a full check
+            mark = self.db.scalar("select max(mod) from notes") or 0
+            cur = dict(col.db.execute(
+                "select id, mod from notes where mod >= ?", mark))
+        old = {}
+        ids = cur.keys()
+        for i in range(0, len(ids), 1000):
+            old.update(self.db.execute(
+                "select id, mod from notes where id in %s" %
+                ids2str(ids[i:i+1000])))
+        stale = [id for id, mod in cur.items() if old.get(id) != mod]
+        # notes deleted since the last update
+        if col.db.scalar("select count() from notes") != (
+            self.db.scalar("select count() from notes") +
+            len([id for id in stale if id not in old])):
+            gone = set(self.db.list("select id from notes"))
+            gone.difference_update(col.db.list("select id from notes"))
+            self._remove(list(gone))
+        self._index(col, stale)
+        self.db.commit()
+
+    def rebuild(self, col):
+        self.db.execute("delete from words")
+        self.db.execute("delete from postings")
+        self.db.execute("delete from notes")
+        self._words = None
+        self._index(col, col.db.list("select id from notes"))
+        self.needsCheck = False
+        self.db.commit()
+
+    def _index(self, col, nids):
+        if not nids:
+            return
+        self._remove(nids)
+        words = self._wordIds()
+        for i in range(0, len(nids), 1000):
+            postings = []
+            notes = []
+            newWords = []
+            for (nid, mod, flds, sfld) in col.db.execute(
+                "select id, mod, flds, sfld from notes where id in %s" %
+                ids2str(nids[i:i+1000])):
+                notes.append((nid, mod))
+                # the sort field is stripped, which may join words together
+                for w in set(wordRe.findall(
+                    (flds + " " + unicode(sfld)).lower())):
+                    wid = words.get(w)
+                    if wid is None:
+                        wid = words[w] = len(words) + 1
+                        newWords.append((wid, w))
+                    postings.append((wid, nid))
+            self.db.executemany("insert into words values (?, ?)", newWords)
+            self.db.executemany("insert into postings values (?, ?)", postings)
+            self.db.executemany("insert into notes values (?, ?)", notes)
+
+    def _remove(self, nids):
+        for i in range(0, len(nids), 1000):
+            sids = ids2str(nids[i:i+1000])
+            self.db.execute("delete from postings where nid in %s" % sids)
+            self.db.execute("delete from notes where id in %s" % sids)
+
+    def _wordIds(self):
+        if self._words is None:
+            self._words = dict(
+                (w, id) for (id, w) in self.db.execute(
+                    "select id, word from words"))
+        return self._words
@@ -398,3 +398,119 @@ def closeTooltip():
     if _tooltipTimer:
         _tooltipTimer.stop()
         _tooltipTimer = None
+
+# Memory use
+######################################################################
+
+def processMemory():
+    "Resident memory of this process in bytes, or None if unknown."
+    try:
+        if isWin:
+            import ctypes
+            class Counters(ctypes.Structure):
+                _fields_ = [("cb", ctypes.c_ulong),
+                            ("PageFaultCount", ctypes.c_ulong)] + [
+                    (name, ctypes.c_size_t) for name in (
+                        "PeakWorkingSetSize", "WorkingSetSize",
+                        "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                        "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage",
+                        "PagefileUsage", "PeakPagefileUsage")]
+            c = Counters()
+            c.cb = ctypes.sizeof(c)
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(c), c.cb):
+                return
+            return c.WorkingSetSize
+        import resource
+        pages = int(open("/proc/self/statm").read().split()[1])
+        return pages * resource.getpagesize()
+    except:
+        return
+
+# Caching
+######################################################################
+
+class LRUCache(object):
+    """A size-bounded mapping that evicts the least recently used entries.
+Sizes are measured with sizeFunc (1 per entry by default), so maxSize can
+be an entry count or an approximate memory budget in bytes."""
+
+    def __init__(self, maxSize, sizeFunc=None):
+        self.maxSize = maxSize
+        self.sizeFunc = sizeFunc or (lambda v: 1)
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        # entries are [prev, next, key, value, size] in a circular list,
+        # with the most recently used entry after the root
+        self._map = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, 0]
+        self.size = 0
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __getitem__(self, key):
+        link = self._map[key]
+        self._moveToFront(link)
+        return link[3]
+
+    def get(self, key, default=None):
+        "Like dict.get(), but records a hit or miss."
+        link = self._map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._moveToFront(link)
+        return link[3]
+
+    def __setitem__(self, key, value):
+        if key in self._map:
+            self._unlink(self._map.pop(key))
+        size = self.sizeFunc(value)
+        root = self._root
+        link = [root, root[1], key, value, size]
+        root[1][0] = link
+        root[1] = link
+        self._map[key] = link
+        self.size += size
+        # always keep the newest entry, even if it's over budget by itself
+        while self.size > self.maxSize and len(self._map) > 1:
+            self._unlink(self._map.pop(root[0][2]))
+
+    def __delitem__(self, key):
+        self._unlink(self._map.pop(key))
+
+    def pop(self, key, default=None):
+        link = self._map.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def keys(self):
+        return self._map.keys()
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        self.size -= link[4]
+
+    def _moveToFront(self, link):
+        root = self._root
+        if root[1] is link:
+            return
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        link[0] = root
+        link[1] = root[1]
+        root[1][0] = link
+        root[1] = link